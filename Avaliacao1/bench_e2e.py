@@ -0,0 +1,251 @@
+"""
+Benchmark ponta a ponta sem RabbitMQ: MS Leilão -> lances dos clientes ->
+MS Lance -> MS Notificação -> clientes, tudo passando pelo fakebroker.
+Mede vazão de lances, latência p50/p99 por etapa e memória conforme o
+número de leilões e de clientes cresce, e grava os resultados em JSON
+para acompanhar regressões.
+
+    python bench_e2e.py --auctions 10 100 --bidders 10 100 --bids 2000 --json results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from Crypto.PublicKey import RSA
+from loguru import logger
+import fakebroker
+import metrics
+import middleware
+import ms_auction
+import ms_bid
+import ms_notification
+import signatures
+import wire
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def latency_summary(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 3) if values else None,
+        "p99_ms": round(percentile(values, 99) * 1000, 3) if values else None,
+    }
+
+def service_args(**overrides):
+    args = SimpleNamespace(manual_ack=False, prefetch=middleware.PREFETCH_COUNT,
+                           ack_batch=middleware.ACK_BATCH_SIZE, ack_interval_ms=middleware.ACK_BATCH_INTERVAL_MS,
+                           workers=0, pool=ms_bid.VERIFY_POOL, conflate_ms=0, asyncio=False)
+    for name, value in overrides.items():
+        setattr(args, name, value)
+    return args
+
+def reset_services(keys_dir, options):
+    # the services keep their state in module globals; start every run from scratch
+    metrics.registry = metrics.Metrics("bench")
+    ms_bid.auctions = ms_bid.AuctionRegistry()
+    ms_bid.key_cache = ms_bid.PublicKeyCache(keys_dir=keys_dir)
+    ms_bid.duplicates = ms_bid.DuplicateFilter()
+    ms_bid.history_dir = os.path.join(keys_dir, "history")
+    ms_bid.verifier = None
+    ms_bid.acker = None
+    ms_bid.journal = None
+    ms_bid.args = service_args(**options)
+    ms_notification.conflation_windows.clear()
+    ms_notification.coalesced_per_auction.clear()
+    ms_notification.acker = None
+    ms_notification.args = service_args(**options)
+
+def write_keys(keys_dir, user_ids, key_pool):
+    for i, user_id in enumerate(user_ids):
+        with open(os.path.join(keys_dir, f"{user_id}_public.pem"), "wb") as f:
+            f.write(key_pool[i % len(key_pool)].publickey().export_key('PEM'))
+
+
+class Bidder:
+    def __init__(self, broker, user_id, results):
+        self.user_id = user_id
+        self.results = results
+        self.channel = broker.connect().channel()
+        self.queue = self.channel.queue_declare(queue='', exclusive=True).method.queue
+        self.subscribed = set()
+        self.channel.basic_consume(queue=self.queue, on_message_callback=self.on_message, auto_ack=True)
+
+    def subscribe(self, auction_id):
+        if auction_id not in self.subscribed:
+            self.subscribed.add(auction_id)
+            self.channel.queue_bind(exchange='direct_exchange', queue=self.queue, routing_key=f"auction_{auction_id}")
+            self.channel.queue_bind(exchange='direct_exchange', queue=self.queue, routing_key=f"leilao_{auction_id}")
+
+    def on_message(self, ch, method, properties, body):
+        message = wire.decode(body, properties.content_type)
+        if 'winner_user_id' in message:
+            if message['winner_user_id'] == self.user_id:
+                self.results["won"] += 1
+            return
+        if message['user_id'] == self.user_id:
+            sent_at = self.results["in_flight"].pop(message.get('bid_id'), None)
+            if sent_at is not None:
+                self.results["e2e"].append(time.perf_counter() - sent_at)
+                self.results["validated"] += 1
+
+
+def run_once(n_auctions, n_bidders, n_bids, key_pool, options, wire_format, burst, trace_memory, seed):
+    random.seed(seed)
+    content_type = wire.CONTENT_TYPES[wire_format]
+    broker = fakebroker.FakeBroker()
+    middleware.connection_factory = broker.connect
+
+    with tempfile.TemporaryDirectory() as keys_dir:
+        user_ids = [f"bench_{i}" for i in range(n_bidders)]
+        write_keys(keys_dir, user_ids, key_pool)
+        reset_services(keys_dir, options)
+        if options.get("journal"):
+            ms_bid.recover_state(os.path.join(keys_dir, "state"))
+        if trace_memory:
+            tracemalloc.start()
+
+        bid_conn = broker.connect()
+        ms_bid.setup(bid_conn, bid_conn.channel())
+        if options.get("workers"):
+            ms_bid.verifier = ms_bid.ParallelVerifier(options["workers"], options.get("pool", ms_bid.VERIFY_POOL))
+        notification_conn = broker.connect()
+        ms_notification.setup(notification_conn, notification_conn.channel())
+
+        results = {"in_flight": {}, "e2e": [], "validated": 0, "won": 0}
+        bidders = [Bidder(broker, user_id, results) for user_id in user_ids]
+
+        # auctions start through ms_auction's own publish path
+        producer = broker.connect().channel()
+        ms_auction.publisher = middleware.Publisher(producer)
+        ms_auction.content_type = content_type
+        now = datetime.now()
+        auctions = [{"id": f"bench{i}", "description": f"item {i}", "start_time": now,
+                     "end_time": now + timedelta(hours=1), "status": "active"} for i in range(n_auctions)]
+        for auction in auctions:
+            ms_auction.publish_auction_start(auction)
+        ms_auction.publisher.flush()
+        broker.run_until_idle()
+
+        # bids are signed up front so the timed part measures the services, not the clients' RSA
+        bids = []
+        for i in range(n_bids):
+            bidder_index = random.randrange(n_bidders)
+            bid = wire.new_bid(auctions[random.randrange(n_auctions)]["id"], user_ids[bidder_index],
+                               round(i + random.uniform(-50, 0), 2))
+            payload = wire.bid_payload(bid, content_type)
+            signature = signatures.sign_bytes(key_pool[bidder_index % len(key_pool)], payload)
+            bids.append((bidders[bidder_index], bid, wire.encode_signed_bid(bid, payload, signature, content_type)))
+
+        properties = middleware.properties_for(content_type)
+        in_flight = lambda: ms_bid.verifier is None or not ms_bid.verifier.pending
+        start = time.perf_counter()
+        for offset in range(0, n_bids, burst):
+            for bidder, bid, body in bids[offset:offset + burst]:
+                bidder.subscribe(bid["auction_id"])
+                results["in_flight"][bid["bid_id"]] = time.perf_counter()
+                producer.basic_publish(exchange='direct_exchange', routing_key='bid_placed', body=body, properties=properties)
+            broker.run_until_idle(until=in_flight)
+        elapsed = time.perf_counter() - start
+
+        for auction in auctions:
+            ms_auction.publish_auction_end(auction)
+        ms_auction.publisher.flush()
+        broker.run_until_idle(wait_timers=True, until=in_flight)
+
+        if ms_bid.verifier is not None:
+            ms_bid.verifier.shutdown()
+        if ms_bid.journal is not None:
+            ms_bid.journal.close()
+
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        client_latencies = [l for q in broker.queues.values() if q.name.startswith("amq.gen-") for l in q.latencies]
+        return {
+            "auctions": n_auctions,
+            "bidders": n_bidders,
+            "bids": n_bids,
+            "wire": wire_format,
+            "options": options,
+            "bids_per_sec": round(n_bids / elapsed, 1),
+            "validated": results["validated"],
+            "winners_received": results["won"],
+            "stages": {
+                "auction_start": latency_summary(broker.queues['ms_bid_queue'].latencies[:n_auctions]),
+                "ms_bid": latency_summary(broker.queues['ms_bid_queue'].latencies[n_auctions:n_auctions + n_bids]),
+                "ms_notification": latency_summary(broker.queues['ms_notification_queue'].latencies),
+                "client": latency_summary(client_latencies),
+                "end_to_end": latency_summary(results["e2e"]),
+            },
+            "counters": metrics.registry.snapshot()["counters"],
+            # peak of this run alone; process RSS would carry earlier runs' peaks and the key generation
+            "memory": {"tracemalloc_peak_kb": round(peak / 1024, 1) if peak is not None else None},
+        }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end throughput over the in-process broker")
+    parser.add_argument("--auctions", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--bidders", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--bids", type=int, default=2000)
+    parser.add_argument("--burst", type=int, default=100, help="bids published before the broker is drained")
+    parser.add_argument("--keys", type=int, default=4, help="distinct RSA keys shared by the simulated bidders")
+    parser.add_argument("--wire", choices=sorted(wire.CONTENT_TYPES), default="binary")
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--pool", choices=["process", "thread"], default=ms_bid.VERIFY_POOL)
+    parser.add_argument("--conflate-ms", type=int, default=0)
+    parser.add_argument("--journal", action="store_true", help="write ms_bid's state log to a temporary directory")
+    parser.add_argument("--manual-ack", action="store_true")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip tracking each run's peak Python memory (tracking slows the run)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write machine-readable results to this file")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(lambda message: None, level="WARNING")
+
+    key_pool = [RSA.generate(2048) for _ in range(args.keys)]
+    options = {"workers": args.workers, "pool": args.pool, "conflate_ms": args.conflate_ms,
+               "journal": args.journal, "manual_ack": args.manual_ack}
+
+    runs = []
+    for n_auctions in args.auctions:
+        for n_bidders in args.bidders:
+            result = run_once(n_auctions, n_bidders, args.bids, key_pool, options, args.wire,
+                              args.burst, not args.no_memory, args.seed)
+            runs.append(result)
+            memory = result['memory']['tracemalloc_peak_kb']
+            stages = "  ".join(f"{name} p50={s['p50_ms']} p99={s['p99_ms']}" for name, s in result["stages"].items())
+            print(f"auctions={n_auctions:<6} bidders={n_bidders:<6} {result['bids_per_sec']:>9} bids/s  "
+                  f"validated={result['validated']:<6} winners={result['winners_received']:<5} "
+                  f"mem={f'{memory}kB' if memory is not None else '-'}  {stages}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"commit": git_commit(), "python": platform.python_version(),
+                       "timestamp": datetime.now().isoformat(), "runs": runs}, f, indent=2)
+        print(f"results written to {args.json}")
+
+if __name__ == "__main__":
+    main()
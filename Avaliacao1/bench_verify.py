@@ -0,0 +1,77 @@
+"""
+Benchmark da verificação de assinaturas do MS Lance: mede lances/s
+verificados em série e com pools de threads/processos de tamanhos
+diferentes, usando as mesmas funções que o ms_bid usa.
+
+    python bench_verify.py --bids 4000 --workers 1 2 4 8
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from Crypto.PublicKey import RSA
+import base64
+import signatures
+
+
+def make_bids(n_bids, n_users):
+    keys = [RSA.generate(2048) for _ in range(n_users)]
+    bids = []
+    for i in range(n_bids):
+        key = keys[i % n_users]
+        message = signatures.canonical_bytes({
+            "auction_id": f"leilao{i % 10}",
+            "user_id": f"bench_{i % n_users}",
+            "bid_amount": float(i + 1),
+        })
+        signature = base64.b64decode(signatures.sign(key, message))
+        bids.append((key.publickey(), message, signature))
+    return bids
+
+def run_serial(bids):
+    start = time.perf_counter()
+    ok = sum(signatures.verify(key, message, signature) for key, message, signature in bids)
+    return ok, time.perf_counter() - start
+
+def run_pool(bids, workers, pool):
+    if pool == 'process':
+        executor = ProcessPoolExecutor(max_workers=workers)
+        fn = signatures.verify_with_numbers
+        jobs = [(key.n, key.e, message, signature) for key, message, signature in bids]
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        fn = signatures.verify
+        jobs = bids
+
+    with executor:
+        # warm up the workers so process start-up isn't measured
+        list(executor.map(fn, *zip(*jobs[:workers])))
+        start = time.perf_counter()
+        futures = [executor.submit(fn, *job) for job in jobs]
+        ok = sum(f.result() for f in futures)
+        return ok, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Signature verification throughput")
+    parser.add_argument("--bids", type=int, default=4000)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument("--pool", choices=["process", "thread", "both"], default="both")
+    args = parser.parse_args()
+
+    print(f"generating {args.users} keys and signing {args.bids} bids...")
+    bids = make_bids(args.bids, args.users)
+
+    ok, elapsed = run_serial(bids)
+    serial_rate = args.bids / elapsed
+    print(f"{'serial':>8} {'-':>3} workers: {serial_rate:10.0f} bids/s  (valid={ok})")
+
+    pools = ["process", "thread"] if args.pool == "both" else [args.pool]
+    for pool in pools:
+        for workers in args.workers:
+            ok, elapsed = run_pool(bids, workers, pool)
+            rate = args.bids / elapsed
+            print(f"{pool:>8} {workers:>3} workers: {rate:10.0f} bids/s  x{rate / serial_rate:.2f}  (valid={ok})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""
+Benchmark do formato das mensagens: custo de codificar, decodificar e
+verificar um lance em JSON (bytes canônicos recalculados no MS Lance) e
+no formato binário (assinatura sobre os próprios bytes da mensagem).
+
+    python bench_wire.py --n 20000
+"""
+import argparse
+import time
+from Crypto.PublicKey import RSA
+import signatures
+import wire
+
+
+def timed(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON vs binary wire format")
+    parser.add_argument("--n", type=int, default=20000)
+    args = parser.parse_args()
+
+    private_key = RSA.generate(2048)
+    public_key = private_key.publickey()
+    bid = wire.new_bid("leilao1", "client_1a2b3c", 1234.5)
+    event = {"id": "leilao1", "description": "chocovo", "start_time": "2025-09-01T10:00:00",
+             "end_time": "2025-09-01T10:01:30", "status": "active"}
+
+    print(f"{'format':>8} {'bid bytes':>10} {'encode us':>10} {'decode us':>10} {'verify us':>10} {'event enc/dec us':>17}")
+    for name, content_type in (("json", wire.JSON), ("binary", wire.BINARY)):
+        payload = wire.bid_payload(bid, content_type)
+        signature = signatures.sign_bytes(private_key, payload)
+        body = wire.encode_signed_bid(bid, payload, signature, content_type)
+
+        # what the client does per bid, minus the RSA signing itself
+        encode = timed(lambda: wire.encode_signed_bid(bid, wire.bid_payload(bid, content_type), signature, content_type), args.n)
+        # what ms_bid does before it can call verify: decode and rebuild the signed bytes
+        decode = timed(lambda: wire.decode_signed_bid(body, content_type), args.n)
+        verify = timed(lambda: signatures.verify(public_key, *wire.decode_signed_bid(body, content_type)[1:]), args.n // 10)
+
+        event_body = wire.encode(wire.AUCTION_STARTED, event, content_type)
+        event_cost = timed(lambda: wire.decode(wire.encode(wire.AUCTION_STARTED, event, content_type), content_type), args.n)
+
+        print(f"{name:>8} {len(body):>10} {encode:>10.2f} {decode:>10.2f} {verify:>10.2f} {event_cost:>17.2f}"
+              f"   (event {len(event_body)} bytes)")
+
+if __name__ == "__main__":
+    main()
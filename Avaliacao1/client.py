@@ -11,39 +11,134 @@ cada lance com sua chave privada.
 consumidor  desse  leilão,  registrando  interesse  em  receber 
 notificações quando um novo lance for efetuado no leilão de seu 
 interesse  ou  quando  o  leilão  for  encerrado.  Por  exemplo,  se  o 
-cliente der um lance no leilão de ID 1, ele escutará a fila leilao_1.'''
+cliente der um lance no leilão de ID 1, ele escutará a fila leilao_1.
+•  Ao entrar, pede ao MS Lance (state_query) os leilões já em andamento
+com o maior lance atual, então um cliente que chega depois do anúncio
+também os vê; o comando "list" mostra essa visão local.'''
 import pika
-import json
 import uuid
 import threading
+import functools
 from loguru import logger
 from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
-from Crypto.Hash import SHA256
-import base64
 import os
+import argparse
+import keygen
+import middleware
+import signatures
+import wire
 
 #unique client id
 CLIENT_ID = f"client_{uuid.uuid4().hex[:6]}"
 
-# digital keys
-private_key = RSA.generate(2048)
-public_key = private_key.publickey()
-
-subscribed_auctions = set()
-lock = threading.Lock() 
-
-def sign_message(message: dict) -> str:
-    message_bytes = json.dumps(message, separators=(',', ':'), sort_keys=True).encode('utf-8')
-    message_hash = SHA256.new(message_bytes)
-    signature = pkcs1_15.new(private_key).sign(message_hash)
-    return base64.b64encode(signature).decode('utf-8')
+# digital keys, loaded or generated in main() so importing the module stays cheap
+private_key = None
+public_key = None
+
+# auction_id -> Event set once the listener has bound our queue to that auction's routes
+subscribed_auctions = {}
+lock = threading.Lock()
+
+# owned by the listener thread; other threads only hand it work via add_callback_threadsafe
+listener_connection = None
+listener_channel = None
+client_queue_name = None
+listener_ready = threading.Event()
+SUBSCRIBE_TIMEOUT = 2.0
+# known auctions we haven't bid on get only the compact price feed; once subscribed, validated bids
+# (conflated by ms_notification) carry the price, so price_<id> is unbound. Listener thread only.
+watched_auctions = set()
+
+# auction_id -> {"description", "end_time", "highest_bid", "status"}, seeded by ms_bid's state reply and
+# kept current by announcements, the price feed, validated bids and winners; bids at or below the known
+# price are not sent, ms_bid would only reject them
+auction_view = {}
+state_query_id = None
+
+def view_of(auction_id):
+    view = auction_view.get(auction_id)
+    if view is None:
+        view = auction_view[auction_id] = {"description": None, "end_time": None, "highest_bid": 0.0, "status": "active"}
+    return view
+
+def update_price(auction_id, amount):
+    view = view_of(auction_id)
+    if amount > view["highest_bid"]:
+        view["highest_bid"] = amount
+
+def apply_state(auctions):
+    for auction in auctions:
+        view = view_of(auction['id'])
+        view["description"] = auction['description']
+        view["end_time"] = auction['end_time']
+        update_price(auction['id'], auction['highest_bid'])
+
+def print_auctions():
+    if not auction_view:
+        logger.info("No auctions known yet.")
+    for auction_id, view in list(auction_view.items()):
+        logger.info(f"Auction {auction_id} [{view['status']}] '{view['description']}' ends {view['end_time']}, best bid ${view['highest_bid']:.2f}")
+
+def query_state(channel):
+    #ask ms_bid for the auctions already running; every shard answers for its own
+    global state_query_id
+    state_query_id = uuid.uuid4().hex
+    channel.basic_publish(
+        exchange='direct_exchange',
+        routing_key='state_query',
+        body=b'',
+        properties=middleware.properties_for(content_type, reply_to=client_queue_name, correlation_id=state_query_id)
+    )
+
+# encoding of the bids this client publishes
+content_type = wire.DEFAULT_FORMAT
+partitions = middleware.PARTITIONS
+
+def encode_bid(bid_message: dict) -> bytes:
+    # the signature covers exactly the payload bytes that go on the wire
+    payload = wire.bid_payload(bid_message, content_type)
+    signature = signatures.sign_bytes(private_key, payload)
+    return wire.encode_signed_bid(bid_message, payload, signature, content_type)
+
+def subscribe(auction_id) -> threading.Event:
+    with lock:
+        bound = subscribed_auctions.get(auction_id)
+        if bound is not None:
+            return bound
+        bound = subscribed_auctions[auction_id] = threading.Event()
+    listener_connection.add_callback_threadsafe(functools.partial(bind_auction, auction_id, bound))
+    return bound
+
+def bind_auction(auction_id, bound):
+    #runs on the listener thread: one binding for validated bids and one for the winner.
+    validated_bid_key = f"auction_{auction_id}"
+    winner_key = f"leilao_{auction_id}"
+
+    listener_channel.queue_bind(exchange='direct_exchange', queue=client_queue_name, routing_key=validated_bid_key)
+    listener_channel.queue_bind(exchange='direct_exchange', queue=client_queue_name, routing_key=winner_key)
+    unwatch(auction_id)
+    bound.set()
+    logger.info(f"[{CLIENT_ID}] Subscribed to receive notifications for auction '{auction_id}'.")
+
+def watch(auction_id):
+    #runs on the listener thread
+    if auction_id in watched_auctions or auction_id in subscribed_auctions:
+        return
+    listener_channel.queue_bind(exchange='direct_exchange', queue=client_queue_name, routing_key=f"price_{auction_id}")
+    watched_auctions.add(auction_id)
+
+def unwatch(auction_id):
+    #runs on the listener thread
+    if auction_id in watched_auctions:
+        listener_channel.queue_unbind(exchange='direct_exchange', queue=client_queue_name, routing_key=f"price_{auction_id}")
+        watched_auctions.discard(auction_id)
 
 def message_listener():
     #listens for rabbit mq
+    global listener_connection, listener_channel, client_queue_name
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-        channel = connection.channel()
+        listener_connection = middleware.get_connection()
+        channel = listener_channel = middleware.get_channel()
 
         #queue for this client to receive all its messages
         result = channel.queue_declare(queue='', durable=False, exclusive=True, auto_delete=True)
@@ -56,15 +151,37 @@ def message_listener():
 
         def callback(ch, method, properties, body):
             #process incoming messages
-            message = json.loads(body)
+            if method.exchange == '':
+                #direct reply to our state query
+                if properties.correlation_id == state_query_id:
+                    auctions = wire.decode_state(body, properties.content_type)
+                    apply_state(auctions)
+                    for auction in auctions:
+                        watch(auction['id'])
+                    if auctions:
+                        logger.info(f"{len(auctions)} auction(s) in progress; type 'list' to see them")
+                return
+
+            message = wire.decode(body, properties.content_type)
+
+            if method.routing_key.startswith('price_'):
+                # silent: only used to skip bids that are already outbid
+                update_price(message['auction_id'], message['highest_bid'])
+                return
             
             if method.exchange == 'auction_fanout_exchange':
+                view = view_of(message['id'])
+                view["description"] = message['description']
+                view["end_time"] = message['end_time']
+                watch(message['id'])
                 logger.info(f"New Auction Started: ID={message['id']}, Description='{message['description']}'")
             
             elif 'winner_user_id' in message:
                 winner_id = message['winner_user_id']
                 auction_id = message['auction_id']
                 amount = message['winning_bid_amount']
+                view_of(auction_id)["status"] = "ended"
+                unwatch(auction_id)
                 
                 if winner_id == CLIENT_ID:
                     logger.success(f"YOU WON auction '{auction_id}' with a bid of ${amount:.2f}!")
@@ -73,30 +190,17 @@ def message_listener():
 
             #if someone bided in an auction this client is subscribed to
             else:
+                 update_price(message['auction_id'], message['bid_amount'])
                  logger.info(f"New Validated Bid: Auction={message['auction_id']}, User={message['user_id']}, Amount=${message['bid_amount']:.2f}")
             
             print("\n> Enter [auction_id] [amount] to place a bid: ", end="")
 
 
         channel.basic_consume(queue=client_queue_name, on_message_callback=callback, auto_ack=True)
-        
-        while True:
-            with lock:
-                auctions_to_check = subscribed_auctions.copy()
+        query_state(channel)
 
-            for auction_id in auctions_to_check:
-                #one for validated bids and another for the winner.
-                validated_bid_key = f"auction_{auction_id}"
-                winner_key = f"leilao_{auction_id}"
-                
-                channel.queue_bind(exchange='direct_exchange', queue=client_queue_name, routing_key=validated_bid_key)
-                channel.queue_bind(exchange='direct_exchange', queue=client_queue_name, routing_key=winner_key)
-                logger.info(f"[{CLIENT_ID}] Subscribed to receive notifications for auction '{auction_id}'.")
-            
-            with lock:
-                subscribed_auctions.difference_update(auctions_to_check)
-
-            connection.sleep(1)
+        listener_ready.set()
+        channel.start_consuming()
 
     except pika.exceptions.AMQPConnectionError as e:
         logger.error(f"Could not connect to RabbitMQ. Please ensure it is running. Error: {e}")
@@ -105,21 +209,48 @@ def message_listener():
 
 
 def main():
+    global content_type, partitions, CLIENT_ID, private_key, public_key
+
+    parser = argparse.ArgumentParser(description="Cliente do leilão")
+    middleware.add_wire_argument(parser)
+    middleware.add_partition_argument(parser)
+    parser.add_argument("--identity",
+                        help="stable client id; its keypair is loaded from (or saved to) identities/ and kept across runs")
+    parser.add_argument("--load", action="store_true",
+                        help="headless load generator; remaining options go to loadgen.py (see loadgen.py --help)")
+    args, rest = parser.parse_known_args()
+    if args.load:
+        import loadgen
+        loadgen.main(rest + ["--wire", args.wire, "--partitions", str(args.partitions)])
+        return
+    if rest:
+        parser.error(f"unrecognized arguments: {' '.join(rest)}")
+    content_type = wire.CONTENT_TYPES[args.wire]
+    partitions = args.partitions
+
+    if args.identity:
+        CLIENT_ID = args.identity
+        private_key = keygen.load_or_create(CLIENT_ID)
+    else:
+        private_key = RSA.generate(keygen.KEY_BITS)
+    public_key = private_key.publickey()
+
     logger.info(f"Client started with ID: {CLIENT_ID}")
 
-    with open(f"keys/{CLIENT_ID}_public.pem", "wb") as f:       
-        f.write(public_key.export_key('PEM'))
-        logger.info(f"Public key saved to keys/{CLIENT_ID}_public.pem")
+    if not args.identity:
+        with open(f"keys/{CLIENT_ID}_public.pem", "wb") as f:
+            f.write(public_key.export_key('PEM'))
+            logger.info(f"Public key saved to keys/{CLIENT_ID}_public.pem")
 
     listener_thread = threading.Thread(target=message_listener, daemon=True)
     listener_thread.start()
 
-    threading.Event().wait(2)
+    if not listener_ready.wait(10):
+        logger.error("Listener did not start. Exiting.")
+        return
 
+    publisher = middleware.Publisher()
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-        channel = connection.channel()
-        
         while True:
             try:
                 # Prompt for user input
@@ -128,6 +259,10 @@ def main():
                 if user_input.lower() == 'exit':
                     break
 
+                if user_input.lower() == 'list':
+                    print_auctions()
+                    continue
+
                 parts = user_input.split()
                 if len(parts) != 2:
                     logger.warning("Invalid input. Please use the format: <auction_id> <amount>")
@@ -136,27 +271,33 @@ def main():
                 auction_id = parts[0]
                 bid_amount = float(parts[1])
 
-                bid_message = {
-                    "auction_id": auction_id,
-                    "user_id": CLIENT_ID,
-                    "bid_amount": bid_amount,
-                }
-                
-                signature = sign_message(bid_message)
-                bid_message_with_signature = bid_message.copy()
-                bid_message_with_signature['signature'] = signature
+                # make sure the bindings exist before the bid can be validated
+                if not subscribe(auction_id).wait(SUBSCRIBE_TIMEOUT):
+                    logger.warning(f"Subscription to auction '{auction_id}' not confirmed yet; notifications may be missed.")
+
+                view = auction_view.get(auction_id)
+                if view is not None and view["status"] == "ended":
+                    logger.warning(f"Auction '{auction_id}' has already ended; bid not sent.")
+                    continue
+                best = view["highest_bid"] if view is not None else None
+                if best is not None and bid_amount <= best:
+                    logger.warning(f"Auction '{auction_id}' is already at ${best:.2f}; bid of ${bid_amount:.2f} not sent.")
+                    continue
 
-                channel.basic_publish(
+                # a fresh bid id and timestamp per bid, both signed: a replayed copy is dropped by ms_bid
+                bid_message = wire.new_bid(auction_id, CLIENT_ID, bid_amount)
+
+                body = encode_bid(bid_message)
+
+                publisher.publish(
                     exchange='direct_exchange',
-                    routing_key='bid_placed', 
-                    body=json.dumps(bid_message_with_signature)
+                    routing_key=middleware.partitioned_key('bid_placed', auction_id, partitions),
+                    body=body,
+                    properties=middleware.properties_for(content_type)
                 )
 
                 logger.success(f"Bid of ${bid_amount:.2f} sent for auction '{auction_id}'.")
 
-                with lock:
-                    subscribed_auctions.add(auction_id)
-
             except ValueError:
                 logger.warning("Invalid bid amount. Please enter a number.")
             except pika.exceptions.AMQPConnectionError as e:
@@ -166,16 +307,16 @@ def main():
                 logger.error(f"An error occurred: {e}")
 
     finally:
-        if 'connection' in locals() and connection.is_open:
-            connection.close()
+        publisher.close()
         logger.info("Client shut down.")
 
-        #delete public key file on exit
-        try:
-            os.remove(f"keys/{CLIENT_ID}_public.pem")
-            logger.info(f"Public key file keys/{CLIENT_ID}_public.pem deleted.")
-        except OSError as e:
-            logger.error(f"Error deleting public key file: {e}")
+        #delete public key file on exit; a persistent identity keeps it registered for the next run
+        if not args.identity:
+            try:
+                os.remove(f"keys/{CLIENT_ID}_public.pem")
+                logger.info(f"Public key file keys/{CLIENT_ID}_public.pem deleted.")
+            except OSError as e:
+                logger.error(f"Error deleting public key file: {e}")
 
 
 if __name__ == "__main__":
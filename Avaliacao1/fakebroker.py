@@ -0,0 +1,284 @@
+"""
+Broker em memória com a mesma superfície do pika usada pelo projeto
+(exchange_declare, queue_declare/bind, basic_publish, basic_consume,
+basic_qos/ack, tx, call_later, add_callback_threadsafe), com roteamento
+fanout/direct. Serve para medir o sistema sem um RabbitMQ rodando:
+
+    broker = FakeBroker()
+    middleware.connection_factory = broker.connect
+    ...
+    broker.run_until_idle()
+
+As entregas acontecem na thread que chama run_until_idle(), na ordem de
+publicação. Cada fila registra a latência publicação -> fim do callback.
+"""
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+
+class FakeBroker:
+    def __init__(self):
+        self.exchanges = {'': 'direct'}
+        # exchange -> routing key -> set of queue names ('' key is used for fanout bindings)
+        self.bindings = {}
+        self.queues = {}
+        # queues holding messages, in the order they became non-empty
+        self._ready = {}
+        self.published = 0
+        self.delivered = 0
+        self._names = itertools.count(1)
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._last_timer = -1
+        self._callbacks = deque()
+        self._wakeup = threading.Condition()
+
+    def connect(self):
+        return FakeConnection(self)
+
+    # routing
+
+    def declare_queue(self, name):
+        if not name:
+            name = f"amq.gen-{next(self._names)}"
+        if name not in self.queues:
+            self.queues[name] = FakeQueue(name)
+        return self.queues[name]
+
+    def route(self, exchange, routing_key, body, properties):
+        self.published += 1
+        if exchange == '':
+            targets = [routing_key] if routing_key in self.queues else []
+        elif self.exchanges.get(exchange) == 'fanout':
+            targets = self.bindings.get(exchange, {}).get('', ())
+        else:
+            targets = self.bindings.get(exchange, {}).get(routing_key, ())
+        now = time.perf_counter()
+        for name in targets:
+            self.queues[name].messages.append((exchange, routing_key, body, properties, now))
+            self._ready[name] = None
+
+    # event loop
+
+    def call_later(self, delay, callback):
+        self._last_timer = next(self._timer_seq)
+        heapq.heappush(self._timers, (time.monotonic() + delay, self._last_timer, callback))
+
+    def add_callback_threadsafe(self, callback):
+        with self._wakeup:
+            self._callbacks.append(callback)
+            self._wakeup.notify()
+
+    def _run_callbacks(self):
+        ran = False
+        while True:
+            with self._wakeup:
+                if not self._callbacks:
+                    return ran
+                callback = self._callbacks.popleft()
+            callback()
+            ran = True
+
+    def _run_timers(self):
+        ran = False
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, callback = heapq.heappop(self._timers)
+            callback()
+            ran = True
+        return ran
+
+    def _deliver_some(self, per_queue=1):
+        # one pass hands each non-empty queue up to per_queue messages, like services running side by side
+        delivered = False
+        for name in list(self._ready):
+            q = self.queues[name]
+            for _ in range(per_queue):
+                if not q.messages:
+                    break
+                consumer = q.next_consumer()
+                if consumer is None:
+                    break
+                exchange, routing_key, body, properties, published_at = q.messages.popleft()
+                consumer.deliver(exchange, routing_key, body, properties)
+                q.latencies.append(time.perf_counter() - published_at)
+                self.delivered += 1
+                delivered = True
+            if not q.messages:
+                self._ready.pop(name, None)
+        return delivered
+
+    def run_until_idle(self, wait_timers=False, until=None, timeout=30.0):
+        # delivers until no queue has deliverable messages; with wait_timers, also waits for the
+        # call_later timers armed while handling messages (periodic ticks that only re-arm
+        # themselves don't count). until() keeps the loop waiting for add_callback_threadsafe work.
+        deadline = time.monotonic() + timeout
+        horizon = self._last_timer
+        while time.monotonic() < deadline:
+            busy = self._run_callbacks()
+            busy = self._deliver_some() or busy
+            if busy:
+                horizon = self._last_timer
+            if self._run_timers() or busy:
+                continue
+            if until is not None and not until():
+                with self._wakeup:
+                    self._wakeup.wait(0.001)
+                continue
+            if wait_timers and any(seq <= horizon for _, seq, _ in self._timers):
+                time.sleep(max(0.0, min(self._timers[0][0] - time.monotonic(), 0.01)))
+                continue
+            return
+        raise TimeoutError("fake broker did not become idle")
+
+    def process_data_events(self, time_limit=0):
+        self._run_callbacks()
+        self._run_timers()
+        self._deliver_some()
+
+
+class FakeQueue:
+    def __init__(self, name):
+        self.name = name
+        self.messages = deque()
+        self.consumers = []
+        self.latencies = []
+        self._turn = 0
+
+    def next_consumer(self):
+        # round robin over consumers that still have room in their prefetch window
+        for _ in range(len(self.consumers)):
+            consumer = self.consumers[self._turn % len(self.consumers)]
+            self._turn += 1
+            if consumer.has_room():
+                return consumer
+        return None
+
+
+class FakeConsumer:
+    def __init__(self, channel, queue, callback, auto_ack):
+        self.channel = channel
+        self.queue = queue
+        self.callback = callback
+        self.auto_ack = auto_ack
+
+    def has_room(self):
+        return self.auto_ack or not self.channel.prefetch or len(self.channel.unacked) < self.channel.prefetch
+
+    def deliver(self, exchange, routing_key, body, properties):
+        channel = self.channel
+        channel.delivery_tag += 1
+        if not self.auto_ack:
+            channel.unacked[channel.delivery_tag] = self.queue
+        method = SimpleNamespace(delivery_tag=channel.delivery_tag, exchange=exchange,
+                                 routing_key=routing_key, redelivered=False)
+        self.callback(channel, method, properties or _EMPTY_PROPERTIES, body)
+
+
+_EMPTY_PROPERTIES = SimpleNamespace(content_type=None, headers=None, reply_to=None, correlation_id=None)
+
+
+class FakeConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_open = True
+        self.is_closed = False
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def close(self):
+        self.is_open = False
+        self.is_closed = True
+
+    def call_later(self, delay, callback):
+        self.broker.call_later(delay, callback)
+
+    def add_callback_threadsafe(self, callback):
+        self.broker.add_callback_threadsafe(callback)
+
+    def process_data_events(self, time_limit=0):
+        self.broker.process_data_events(time_limit)
+
+    def sleep(self, duration):
+        self.broker.run_until_idle()
+        time.sleep(duration)
+
+
+class FakeChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self.delivery_tag = 0
+        self.prefetch = 0
+        # delivery tag -> queue name, for manual-ack consumers
+        self.unacked = {}
+        self._tx = None
+        self._tx_acks = []
+        self._consuming = False
+
+    def exchange_declare(self, exchange, exchange_type='direct', **kwargs):
+        self.broker.exchanges.setdefault(exchange, exchange_type)
+
+    def queue_declare(self, queue='', **kwargs):
+        q = self.broker.declare_queue(queue)
+        return SimpleNamespace(method=SimpleNamespace(queue=q.name, message_count=len(q.messages)))
+
+    def queue_bind(self, queue, exchange, routing_key=None, **kwargs):
+        key = '' if self.broker.exchanges.get(exchange) == 'fanout' else (routing_key or queue)
+        self.broker.bindings.setdefault(exchange, {}).setdefault(key, set()).add(queue)
+
+    def queue_unbind(self, queue, exchange, routing_key=None, **kwargs):
+        self.broker.bindings.get(exchange, {}).get(routing_key or '', set()).discard(queue)
+
+    def basic_qos(self, prefetch_count=0, **kwargs):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, **kwargs):
+        self.broker.queues[queue].consumers.append(FakeConsumer(self, queue, on_message_callback, auto_ack))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        if self._tx is not None:
+            self._tx.append((exchange, routing_key, body, properties))
+        else:
+            self.broker.route(exchange, routing_key, body, properties)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if self._tx is not None:
+            self._tx_acks.append((delivery_tag, multiple))
+        else:
+            self._ack(delivery_tag, multiple)
+
+    def _ack(self, delivery_tag, multiple):
+        if multiple:
+            for tag in [t for t in self.unacked if t <= delivery_tag]:
+                del self.unacked[tag]
+        else:
+            self.unacked.pop(delivery_tag, None)
+
+    def tx_select(self, **kwargs):
+        self._tx = []
+
+    def tx_commit(self, **kwargs):
+        pending, self._tx = self._tx, []
+        for message in pending:
+            self.broker.route(*message)
+        acks, self._tx_acks = self._tx_acks, []
+        for delivery_tag, multiple in acks:
+            self._ack(delivery_tag, multiple)
+
+    def start_consuming(self):
+        # like pika, blocks until stop_consuming(), running deliveries, timers and threadsafe callbacks
+        self._consuming = True
+        self.broker.run_until_idle(until=lambda: not self._consuming, timeout=float('inf'))
+
+    def stop_consuming(self):
+        self._consuming = False
+
+    def close(self):
+        self.is_open = False
@@ -0,0 +1,138 @@
+"""
+Histórico de lances do MS Lance em colunas: valores e timestamps em
+array('d') e usuários como índices numa tabela de nomes do próprio
+leilão, em vez de um dict por lance; a tabela vai embora junto com o
+histórico quando ele é despejado. Quando o leilão termina o histórico vai
+para um arquivo compacto e passa a ser lido por mmap só quando alguém
+o consulta, então a memória residente acompanha os lances dos leilões
+ativos e não o histórico inteiro.
+
+Arquivo: cabeçalho (b'BIDH', versão, lances, usuários), valores f64,
+timestamps f64, índices u32 e a tabela de usuários (u16 + utf-8).
+"""
+import mmap
+import os
+import struct
+from array import array
+from urllib.parse import quote
+
+MAGIC = b'BIDH'
+VERSION = 1
+
+_header = struct.Struct('<4sHII')
+_u16 = struct.Struct('<H')
+
+
+class BidHistory:
+    # user ids repeat across an auction's bids; each distinct one is stored once per auction
+    __slots__ = ("amounts", "timestamps", "users", "names", "_index")
+
+    def __init__(self):
+        self.amounts = array('d')
+        self.timestamps = array('d')
+        self.users = array('I')
+        self.names = []
+        self._index = {}
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def append(self, user_id, amount, timestamp=None):
+        self.amounts.append(amount)
+        self.timestamps.append(timestamp if timestamp is not None else 0.0)
+        index = self._index.get(user_id)
+        if index is None:
+            index = self._index[user_id] = len(self.names)
+            self.names.append(user_id)
+        self.users.append(index)
+
+    def __iter__(self):
+        # (user_id, amount, timestamp), oldest first
+        for i in range(len(self.amounts)):
+            yield self.names[self.users[i]], self.amounts[i], self.timestamps[i]
+
+    def columns(self):
+        return {"users": [self.names[u] for u in self.users],
+                "amounts": list(self.amounts), "timestamps": list(self.timestamps)}
+
+    def spill(self, path):
+        # writes the history to path (atomically, fsynced) and returns its on-disk replacement
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_header.pack(MAGIC, VERSION, len(self.amounts), len(self.names)))
+            f.write(_little(self.amounts).tobytes())
+            f.write(_little(self.timestamps).tobytes())
+            f.write(_little(self.users).tobytes())
+            for name in self.names:
+                name = name.encode('utf-8')
+                f.write(_u16.pack(len(name)))
+                f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return SpilledHistory(path, len(self.amounts))
+
+
+class SpilledHistory:
+    # an ended auction's bids on disk; the file is mapped only while it is being read
+    __slots__ = ("path", "count")
+
+    def __init__(self, path, count=None):
+        self.path = path
+        if count is None:
+            with open(path, 'rb') as f:
+                magic, version, count, _ = _header.unpack(f.read(_header.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a bid history file")
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        if not self.count:
+            return
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            _, _, count, n_users = _header.unpack_from(m, 0)
+            offset = _header.size
+            amounts = _read(m, 'd', offset, count)
+            offset += 8 * count
+            timestamps = _read(m, 'd', offset, count)
+            offset += 8 * count
+            indexes = _read(m, 'I', offset, count)
+            offset += 4 * count
+            names = []
+            for _ in range(n_users):
+                (length,) = _u16.unpack_from(m, offset)
+                offset += _u16.size
+                names.append(m[offset:offset + length].decode('utf-8'))
+                offset += length
+        for i in range(count):
+            yield names[indexes[i]], amounts[i], timestamps[i]
+
+    def columns(self):
+        rows = list(self)
+        return {"users": [r[0] for r in rows], "amounts": [r[1] for r in rows], "timestamps": [r[2] for r in rows]}
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _little(values):
+    # files are little-endian whatever the host is
+    if struct.pack('=H', 1) == struct.pack('<H', 1):
+        return values
+    swapped = array(values.typecode, values)
+    swapped.byteswap()
+    return swapped
+
+def _read(m, typecode, offset, count):
+    values = array(typecode)
+    values.frombytes(m[offset:offset + values.itemsize * count])
+    return _little(values)
+
+def path_for(directory, auction_id):
+    return os.path.join(directory, quote(str(auction_id), safe='') + '.bids')
@@ -0,0 +1,147 @@
+"""
+Log de escrita antecipada (WAL) e snapshots para o estado do MS Lance.
+Cada evento aceito (leilão iniciado, lance aceito, leilão encerrado) é
+anexado ao segmento atual; commit() faz um único fsync para o grupo de
+eventos acumulado (group commit). A cada snapshot_every eventos o estado
+inteiro é gravado num snapshot compacto e o log recomeça num segmento
+novo, então a recuperação lê no máximo um snapshot e um segmento.
+
+    state/wal-000042.log       registros: tamanho u32, crc32 u32, JSON
+    state/snapshot-000042.json estado no início do wal-000042.log
+"""
+import json
+import os
+import re
+import struct
+import zlib
+from loguru import logger
+
+SNAPSHOT_EVERY = 10000
+
+_header = struct.Struct('>II')
+_segment_name = re.compile(r'^(wal|snapshot)-(\d+)\.(log|json)$')
+
+
+class Journal:
+    def __init__(self, directory, snapshot_every=SNAPSHOT_EVERY, state_fn=None):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        # returns the service state as a JSON-serializable dict, called when a snapshot is due
+        self.state_fn = state_fn
+        self.segment = 0
+        self.since_snapshot = 0
+        self.appended = 0
+        self.commits = 0
+        self._file = None
+        self._dirty = False
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, kind, segment):
+        extension = 'log' if kind == 'wal' else 'json'
+        return os.path.join(self.directory, f"{kind}-{segment:06d}.{extension}")
+
+    def _segments(self, kind):
+        found = []
+        for name in os.listdir(self.directory):
+            match = _segment_name.match(name)
+            if match and match.group(1) == kind:
+                found.append(int(match.group(2)))
+        return sorted(found)
+
+    def recover(self):
+        # returns (snapshot state or None, records logged after it) and opens the log for appending
+        state = None
+        start = 0
+        for segment in reversed(self._segments('snapshot')):
+            try:
+                with open(self._path('snapshot', segment), 'rb') as f:
+                    state = json.load(f)
+                start = segment
+                break
+            except (OSError, ValueError) as e:
+                logger.warning("Skipping unreadable snapshot {}: {}", segment, e)
+
+        records = []
+        segments = [s for s in self._segments('wal') if s >= start]
+        for segment in segments:
+            good = self._read_segment(self._path('wal', segment), records)
+            if segment == segments[-1]:
+                # a crash mid-append leaves a torn record at the tail; drop it before appending
+                with open(self._path('wal', segment), 'r+b') as f:
+                    f.truncate(good)
+        self.segment = segments[-1] if segments else start
+        self.since_snapshot = len(records)
+        self._file = open(self._path('wal', self.segment), 'ab')
+        logger.info("Journal recovered: snapshot {} + {} logged events", start if state is not None else None, len(records))
+        return state, records
+
+    def _read_segment(self, path, records):
+        good = 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        while good + _header.size <= len(data):
+            length, crc = _header.unpack_from(data, good)
+            end = good + _header.size + length
+            payload = data[good + _header.size:end]
+            if end > len(data) or zlib.crc32(payload) != crc:
+                logger.warning("Journal {} ends with a torn record at offset {}", path, good)
+                break
+            records.append(json.loads(payload))
+            good = end
+        return good
+
+    def append(self, record):
+        payload = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        self._file.write(_header.pack(len(payload), zlib.crc32(payload)))
+        self._file.write(payload)
+        self._dirty = True
+        self.appended += 1
+        self.since_snapshot += 1
+
+    def commit(self):
+        # one fsync for everything appended since the last commit
+        self._sync_log()
+        if self.state_fn is not None and self.since_snapshot >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        self._sync_log()
+        segment = self.segment + 1
+        path = self._path('snapshot', segment)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.state_fn(), f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self._sync_directory()
+
+        # the new segment starts where the snapshot left off; older files are no longer needed
+        self._file.close()
+        self.segment = segment
+        self._file = open(self._path('wal', segment), 'ab')
+        self.since_snapshot = 0
+        for kind in ('wal', 'snapshot'):
+            for old in self._segments(kind):
+                if old < segment:
+                    os.remove(self._path(kind, old))
+        logger.info("Journal snapshot {} written", segment)
+
+    def _sync_log(self):
+        if self._dirty:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._dirty = False
+            self.commits += 1
+
+    def _sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        if self._file is not None:
+            self._sync_log()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,100 @@
+"""
+Pares de chaves persistentes por identidade de cliente. A chave privada
+fica em identities/<id>_private.pem e a pública em keys/<id>_public.pem,
+onde o MS Lance a procura; um cliente que reusa a identidade não gera
+chave nem mexe em keys/ ao iniciar.
+
+Gera em paralelo um lote de identidades para frotas de teste:
+
+    python keygen.py --prefix fleet --count 200
+    python client.py --identity fleet_7
+    python loadgen.py --identity-prefix fleet --bidders 200
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from Crypto.PublicKey import RSA
+from loguru import logger
+
+KEYS_DIR = "keys"
+IDENTITIES_DIR = "identities"
+KEY_BITS = 2048
+
+
+def private_path(identity):
+    return os.path.join(IDENTITIES_DIR, f"{identity}_private.pem")
+
+def public_path(identity):
+    return os.path.join(KEYS_DIR, f"{identity}_public.pem")
+
+def generate_pem(bits=KEY_BITS):
+    # runs in pool workers; PEM bytes pickle where RsaKey objects don't
+    return RSA.generate(bits).export_key('PEM')
+
+def save(identity, private_pem):
+    os.makedirs(IDENTITIES_DIR, exist_ok=True)
+    os.makedirs(KEYS_DIR, exist_ok=True)
+    # written owner-only and renamed into place so a crash never leaves half a key
+    tmp = private_path(identity) + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(private_pem)
+    os.replace(tmp, private_path(identity))
+    publish_public(identity, RSA.import_key(private_pem))
+
+def publish_public(identity, key):
+    public_pem = key.publickey().export_key('PEM')
+    path = public_path(identity)
+    try:
+        with open(path, "rb") as f:
+            if f.read() == public_pem:
+                return
+    except OSError:
+        pass
+    os.makedirs(KEYS_DIR, exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(public_pem)
+    os.replace(tmp, path)
+
+def load(identity):
+    try:
+        with open(private_path(identity), "rb") as f:
+            return RSA.import_key(f.read())
+    except FileNotFoundError:
+        return None
+
+def load_or_create(identity, bits=KEY_BITS):
+    key = load(identity)
+    if key is None:
+        logger.info("No key for identity {}; generating one", identity)
+        save(identity, generate_pem(bits))
+        key = load(identity)
+    # the public half may have been cleaned out of keys/ since
+    publish_public(identity, key)
+    return key
+
+def generate_pool(prefix, count, bits=KEY_BITS, workers=None):
+    missing = [f"{prefix}_{i}" for i in range(count) if not os.path.exists(private_path(f"{prefix}_{i}"))]
+    if missing:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for identity, pem in zip(missing, pool.map(generate_pem, [bits] * len(missing))):
+                save(identity, pem)
+    return [f"{prefix}_{i}" for i in range(count)], len(missing)
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera um lote de identidades de cliente")
+    parser.add_argument("--prefix", default="fleet")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--bits", type=int, default=KEY_BITS)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    identities, generated = generate_pool(args.prefix, args.count, args.bits, args.workers)
+    logger.info("{} identities {}_0..{}_{} ready ({} generated) in {:.2f}s", len(identities), args.prefix,
+                args.prefix, args.count - 1, generated, time.perf_counter() - start)
+
+if __name__ == "__main__":
+    main()
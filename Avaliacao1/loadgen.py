@@ -0,0 +1,348 @@
+"""
+Gerador de carga sem interação: simula N clientes dando lances em M
+leilões com taxa e estratégia de incremento configuráveis. As chaves
+são geradas em paralelo, as assinaturas rodam num pool de processos e
+todos os clientes simulados compartilham poucas conexões de publicação.
+Ao final informa lances enviados, validados e leilões ganhos, e a
+latência ponta a ponta (publicação -> bid_validated correspondente).
+
+    python loadgen.py --bidders 50 --auctions leilao1 leilao2 --rate 2 --duration 30
+    python client.py --load --bidders 50 --duration 30
+"""
+import argparse
+import functools
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from Crypto.PublicKey import RSA
+from loguru import logger
+import keygen
+import middleware
+import signatures
+import wire
+
+SUBSCRIBE_TIMEOUT = 2.0
+# rejected bids never come back; stop draining once notifications stop arriving for this long
+DRAIN_QUIET_SECONDS = 1.0
+STRATEGIES = ("fixed", "percent", "random")
+
+
+def generate_numbers(bits):
+    key = RSA.generate(bits)
+    return key.n, key.e, key.d
+
+def next_amount(strategy, current, increment):
+    if strategy == "percent":
+        amount = current * (1 + increment / 100.0) if current else increment
+    elif strategy == "random":
+        # may undercut the known price, so some bids get rejected like real ones do
+        amount = current + random.uniform(-increment, 2 * increment)
+    else:
+        amount = current + increment
+    return round(max(amount, 0.01), 2)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class Listener:
+    # one queue for the whole fleet, bound to every auction it bids on
+    def __init__(self, bidder_ids, discover):
+        self.bidder_ids = set(bidder_ids)
+        self.discover = discover
+        self.connection = None
+        self.channel = None
+        self.queue = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.auctions = []
+        self.bound = {}
+        self.highest = {}
+        self.sent_at = {}
+        self.latencies = []
+        self.winners = {}
+        self.validated = 0
+        self.won = 0
+        self.last_message = time.monotonic()
+
+    def start(self):
+        threading.Thread(target=self._run, name="loadgen-listener", daemon=True).start()
+
+    def _run(self):
+        self.connection = middleware.get_connection()
+        self.channel = middleware.get_channel()
+        self.queue = self.channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+        if self.discover:
+            self.channel.queue_bind(exchange='auction_fanout_exchange', queue=self.queue)
+            # auctions that started before we did are only known to ms_bid; ask it for them
+            self.channel.basic_publish(exchange='direct_exchange', routing_key='state_query', body=b'',
+                                       properties=middleware.properties_for(wire.DEFAULT_FORMAT, reply_to=self.queue))
+        self.channel.basic_consume(queue=self.queue, on_message_callback=self._on_message, auto_ack=True)
+        self.ready.set()
+        self.channel.start_consuming()
+
+    def subscribe(self, auction_id) -> threading.Event:
+        with self.lock:
+            bound = self.bound.get(auction_id)
+            if bound is not None:
+                return bound
+            bound = self.bound[auction_id] = threading.Event()
+        self.connection.add_callback_threadsafe(functools.partial(self._bind, auction_id, bound))
+        return bound
+
+    def _bind(self, auction_id, bound):
+        self.channel.queue_bind(exchange='direct_exchange', queue=self.queue, routing_key=f"auction_{auction_id}")
+        self.channel.queue_bind(exchange='direct_exchange', queue=self.queue, routing_key=f"leilao_{auction_id}")
+        bound.set()
+
+    def sent(self, bid_id):
+        self.sent_at[bid_id] = time.perf_counter()
+
+    def _discovered(self, auction_id):
+        # runs on the listener thread, so it can bind right away
+        with self.lock:
+            if auction_id in self.bound:
+                return
+            self.bound[auction_id] = threading.Event()
+            self.auctions.append(auction_id)
+        self._bind(auction_id, self.bound[auction_id])
+        logger.info("Auction {} running; bidding on it", auction_id)
+
+    def _on_message(self, ch, method, properties, body):
+        self.last_message = time.monotonic()
+        if method.exchange == '':
+            # state reply: the auctions already running when we asked
+            for auction in wire.decode_state(body, properties.content_type):
+                if auction['highest_bid'] > self.highest.get(auction['id'], 0):
+                    self.highest[auction['id']] = auction['highest_bid']
+                self._discovered(auction['id'])
+            return
+        message = wire.decode(body, properties.content_type)
+        if method.exchange == 'auction_fanout_exchange':
+            self._discovered(message['id'])
+        elif 'winner_user_id' in message:
+            self.winners[message['auction_id']] = message['winner_user_id']
+            if message['winner_user_id'] in self.bidder_ids:
+                self.won += 1
+        else:
+            auction_id = message['auction_id']
+            if message['bid_amount'] > self.highest.get(auction_id, 0):
+                self.highest[auction_id] = message['bid_amount']
+            sent_at = self.sent_at.pop(message.get('bid_id'), None)
+            if sent_at is not None:
+                self.latencies.append(time.perf_counter() - sent_at)
+                self.validated += 1
+
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.content_type = wire.CONTENT_TYPES[args.wire]
+        if args.identity_prefix:
+            self.bidder_ids = [f"{args.identity_prefix}_{i}" for i in range(args.bidders)]
+        else:
+            run_id = uuid.uuid4().hex[:4]
+            self.bidder_ids = [f"load_{run_id}_{i}" for i in range(args.bidders)]
+        self.keys = []
+        self.key_files = []
+        self.listener = Listener(self.bidder_ids, discover=not args.auctions)
+        self.publishers = [middleware.Publisher() for _ in range(args.connections)]
+        self.pool = ProcessPoolExecutor(max_workers=args.sign_workers)
+        self.window = threading.BoundedSemaphore(args.max_pending)
+        self.last_amount = {}
+        self.sent = 0
+        self.failed = 0
+
+    def prepare_keys(self):
+        start = time.perf_counter()
+        if self.args.identity_prefix:
+            # persistent pool: only missing identities are generated, keys/ is left as it is
+            _, generated = keygen.generate_pool(self.args.identity_prefix, len(self.bidder_ids),
+                                                self.args.key_bits, self.args.sign_workers)
+            for identity in self.bidder_ids:
+                key = keygen.load_or_create(identity, self.args.key_bits)
+                self.keys.append((key.n, key.e, key.d))
+            logger.info("{} identities loaded ({} generated) in {:.2f}s", len(self.keys), generated,
+                        time.perf_counter() - start)
+            return
+        # a fleet shares a handful of keys: each one still signs and verifies for real
+        n_keys = min(self.args.keys, len(self.bidder_ids))
+        self.keys = list(self.pool.map(generate_numbers, [self.args.key_bits] * n_keys))
+        os.makedirs(keygen.KEYS_DIR, exist_ok=True)
+        for i, user_id in enumerate(self.bidder_ids):
+            n, e, _ = self.keys[i % n_keys]
+            path = keygen.public_path(user_id)
+            with open(path, "wb") as f:
+                f.write(RSA.construct((n, e)).export_key('PEM'))
+            self.key_files.append(path)
+        logger.info("{} keys for {} bidders ready in {:.2f}s", n_keys, len(self.bidder_ids), time.perf_counter() - start)
+
+    def remove_keys(self):
+        for path in self.key_files:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("Could not remove {}: {}", path, e)
+
+    def wait_for_auctions(self):
+        if self.args.auctions:
+            self.listener.auctions.extend(self.args.auctions)
+            for auction_id in self.args.auctions:
+                if not self.listener.subscribe(auction_id).wait(SUBSCRIBE_TIMEOUT):
+                    logger.warning("Subscription to auction {} not confirmed yet", auction_id)
+            return True
+        logger.info("Waiting up to {}s for auction announcements", self.args.discover_timeout)
+        deadline = time.monotonic() + self.args.discover_timeout
+        while not self.listener.auctions and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return bool(self.listener.auctions)
+
+    def place_bid(self):
+        index = random.randrange(len(self.bidder_ids))
+        auction_id = random.choice(self.listener.auctions)
+        current = max(self.listener.highest.get(auction_id, 0), self.last_amount.get(auction_id, 0))
+        amount = next_amount(self.args.strategy, current, self.args.increment)
+        self.last_amount[auction_id] = max(amount, self.last_amount.get(auction_id, 0))
+        bid = wire.new_bid(auction_id, self.bidder_ids[index], amount)
+
+        payload = wire.bid_payload(bid, self.content_type)
+        self.window.acquire()
+        future = self.pool.submit(signatures.sign_with_numbers, *self.keys[index % len(self.keys)], payload)
+        future.add_done_callback(functools.partial(self._signed, bid, payload, self.publishers[index % len(self.publishers)]))
+
+    def _signed(self, bid, payload, publisher, future):
+        # runs on the pool's result thread; publishers are thread-safe queues
+        try:
+            body = wire.encode_signed_bid(bid, payload, future.result(), self.content_type)
+            self.listener.sent(bid["bid_id"])
+            routing_key = middleware.partitioned_key('bid_placed', bid["auction_id"], self.args.partitions)
+            publisher.publish(exchange='direct_exchange', routing_key=routing_key, body=body,
+                              properties=middleware.properties_for(self.content_type))
+            self.sent += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error("Could not send bid {}: {}", bid, e)
+        finally:
+            self.window.release()
+
+    def run(self):
+        args = self.args
+        self.listener.start()
+        if not self.listener.ready.wait(10):
+            logger.error("Listener did not start")
+            return None
+        self.prepare_keys()
+        if not self.wait_for_auctions():
+            logger.error("No auctions to bid on")
+            return None
+
+        # Poisson arrivals at the fleet's aggregate rate
+        total_rate = args.rate * len(self.bidder_ids)
+        start = time.perf_counter()
+        next_at = start
+        placed = 0
+        if args.bids:
+            more = lambda: placed < args.bids
+        else:
+            more = lambda: time.perf_counter() - start < args.duration
+        while more():
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.place_bid()
+            placed += 1
+            next_at += random.expovariate(total_rate)
+        for publisher in self.publishers:
+            publisher.flush()
+        elapsed = time.perf_counter() - start
+
+        # give in-flight bids time to come back validated (rejected ones never do)
+        start_drain = time.monotonic()
+        deadline = time.monotonic() + args.drain
+        while self.listener.sent_at and time.monotonic() < deadline:
+            if time.monotonic() - max(self.listener.last_message, start_drain) > DRAIN_QUIET_SECONDS:
+                break
+            time.sleep(0.05)
+        if args.wait_winners:
+            deadline = time.monotonic() + args.wait_winners
+            while len(self.listener.winners) < len(self.listener.auctions) and time.monotonic() < deadline:
+                time.sleep(0.1)
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        latencies = self.listener.latencies
+        return {
+            "bidders": len(self.bidder_ids),
+            "auctions": list(self.listener.auctions),
+            "strategy": self.args.strategy,
+            "sent": self.sent,
+            "failed": self.failed,
+            "validated": self.listener.validated,
+            "won": self.listener.won,
+            "bids_per_sec": round(self.sent / elapsed, 1) if elapsed else 0.0,
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50) * 1000, 3),
+                "p99": round(percentile(latencies, 99) * 1000, 3),
+                "max": round(max(latencies) * 1000, 3),
+            } if latencies else None,
+        }
+
+    def close(self):
+        for publisher in self.publishers:
+            publisher.close()
+        self.pool.shutdown(wait=True)
+        if not self.args.keep_keys:
+            self.remove_keys()
+
+
+def add_arguments(parser):
+    parser.add_argument("--bidders", type=int, default=10, help="simulated clients")
+    parser.add_argument("--auctions", nargs="*", default=[],
+                        help="auction ids to bid on (default: every auction announced while running)")
+    parser.add_argument("--discover-timeout", type=float, default=60.0)
+    parser.add_argument("--rate", type=float, default=1.0, help="bids per second per bidder")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--bids", type=int, default=0, help="stop after this many bids instead of --duration")
+    parser.add_argument("--strategy", choices=STRATEGIES, default="fixed",
+                        help="how a bid is priced from the highest known bid of the auction")
+    parser.add_argument("--increment", type=float, default=1.0,
+                        help="price step (percent for --strategy percent)")
+    parser.add_argument("--keys", type=int, default=8, help="distinct keypairs shared by the fleet")
+    parser.add_argument("--key-bits", type=int, default=keygen.KEY_BITS)
+    parser.add_argument("--identity-prefix",
+                        help="bid as persistent identities PREFIX_0..N-1 (see keygen.py) instead of throwaway keys")
+    parser.add_argument("--keep-keys", action="store_true", help="leave the public keys in keys/ on exit")
+    parser.add_argument("--sign-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--connections", type=int, default=2, help="publishing connections shared by all bidders")
+    parser.add_argument("--max-pending", type=int, default=256, help="bids being signed at once")
+    parser.add_argument("--drain", type=float, default=5.0, help="seconds to wait for outstanding validations")
+    parser.add_argument("--wait-winners", type=float, default=0,
+                        help="seconds to wait for the winner of every auction (0 skips)")
+    parser.add_argument("--json", help="write the report to this file")
+    middleware.add_wire_argument(parser)
+    middleware.add_partition_argument(parser)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gerador de carga de lances")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    generator = LoadGenerator(args)
+    try:
+        result = generator.run()
+    finally:
+        generator.close()
+    if result is None:
+        return
+    logger.info("Load report: {}", result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Métricas dos serviços: contadores, histogramas de latência por handler,
+mensagens por segundo e trabalho em andamento. Um snapshot pode ser
+despejado no log periodicamente (--metrics-interval) ou servido em JSON
+por um endpoint local (--metrics-port, GET /metrics).
+"""
+import bisect
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+
+# upper bounds in seconds, roughly x2.5 apart from 10us to 10s
+BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3,
+           1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile
+        if not self.count:
+            return 0.0
+        target = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class Metrics:
+    def __init__(self, service=""):
+        self.service = service
+        self.counters = {}
+        self.histograms = {}
+        self.in_flight = 0
+        self.messages = 0
+        self._started = time.monotonic()
+        self._last = (self._started, 0)
+        # updates also come from executor and verifier threads
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def received(self):
+        with self._lock:
+            self.messages += 1
+            self.in_flight += 1
+
+    def finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        now = time.monotonic()
+        last_time, last_messages = self._last
+        self._last = (now, self.messages)
+        return {
+            "service": self.service,
+            "uptime_s": round(now - self._started, 1),
+            "messages": self.messages,
+            "messages_per_sec": round((self.messages - last_messages) / (now - last_time), 1) if now > last_time else 0.0,
+            "in_flight": self.in_flight,
+            "counters": dict(self.counters),
+            "latency": {name: h.snapshot() for name, h in list(self.histograms.items())},
+        }
+
+
+registry = Metrics()
+
+
+def start_reporter(interval, metrics=None):
+    def run():
+        while True:
+            time.sleep(interval)
+            logger.info("metrics {}", json.dumps((metrics or registry).snapshot()))
+    threading.Thread(target=run, name="metrics-reporter", daemon=True).start()
+
+def serve(port, metrics=None, host="127.0.0.1"):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") not in ("", "/metrics"):
+                self.send_error(404)
+                return
+            body = json.dumps((metrics or registry).snapshot()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("Metrics served on http://{}:{}/metrics", host, server.server_address[1])
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--log-level", default="INFO",
+                        help="minimum log level; per-message logs are DEBUG and cost nothing below it")
+    parser.add_argument("--metrics-interval", type=float, default=0,
+                        help="log a metrics snapshot every N seconds (0 disables)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve metrics as JSON on localhost:PORT/metrics (0 disables)")
+
+def start_from_args(args, service):
+    registry.service = service
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level.upper())
+    if args.metrics_interval > 0:
+        start_reporter(args.metrics_interval)
+    if args.metrics_port:
+        serve(args.metrics_port)
@@ -5,20 +5,363 @@ filas, onde os produtores (publishers) as enviam e os
 consumidores/assinantes (subscribers) as recebem.
 """
 import pika
+import queue
+import wire
+import asyncio
+import threading
+import time
+import zlib
+from pika.adapters.asyncio_connection import AsyncioConnection
+from loguru import logger
 
-def connect_to_rabbitmq():
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-    channel = connection.channel()
-    return connection, channel
+HOST = 'localhost'
+RECONNECT_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
 
-def declare_exchanges():
-    connection, channel = connect_to_rabbitmq()
+PREFETCH_COUNT = 200
+ACK_BATCH_SIZE = 100
+ACK_BATCH_INTERVAL_MS = 50
+
+PUBLISH_BATCH_SIZE = 500
+PUBLISH_FLUSH_INTERVAL = 0.05
+
+# bids and auction ends are routed by a hash of the auction id so each ms_bid shard only
+# receives its own auctions; 1 keeps the plain 'bid_placed'/'auction_ended' keys
+PARTITIONS = 1
+
+# pika connections and channels must only be used from the thread that created them,
+# so every thread gets its own long-lived connection and channel
+_local = threading.local()
+
+def _blocking_connection():
+    return pika.BlockingConnection(pika.ConnectionParameters(host=HOST))
+
+# swapped for fakebroker.FakeBroker.connect to run everything in-process
+connection_factory = _blocking_connection
+
+def get_connection():
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and connection.is_open:
+        return connection
+
+    delay = RECONNECT_DELAY
+    while True:
+        try:
+            connection = connection_factory()
+            break
+        except pika.exceptions.AMQPConnectionError as e:
+            logger.warning(f"Could not connect to RabbitMQ ({e}). Retrying in {delay:.0f}s.")
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    _local.connection = connection
+    _local.channel = None
+    return connection
+
+def get_channel():
+    connection = get_connection()
+    channel = getattr(_local, 'channel', None)
+    if channel is None or not channel.is_open:
+        channel = _local.channel = connection.channel()
+    return channel
+
+def reset_connection():
+    # drops this thread's connection so the next get_connection() opens a fresh one
+    connection = getattr(_local, 'connection', None)
+    _local.connection = None
+    _local.channel = None
+    if connection is not None and connection.is_open:
+        try:
+            connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+
+_properties = {}
+
+def properties_for(content_type, reply_to=None, correlation_id=None):
+    if reply_to is not None or correlation_id is not None:
+        # request/reply properties differ per message
+        return pika.BasicProperties(content_type=content_type, reply_to=reply_to, correlation_id=correlation_id)
+    # BasicProperties are immutable in practice here, so one instance per content type is reused
+    properties = _properties.get(content_type)
+    if properties is None:
+        properties = _properties[content_type] = pika.BasicProperties(content_type=content_type)
+    return properties
+
+def add_wire_argument(parser):
+    parser.add_argument("--wire", choices=sorted(wire.CONTENT_TYPES), default="binary",
+                        help="encoding of the messages this component publishes")
+
+def add_partition_argument(parser):
+    parser.add_argument("--partitions", type=int, default=PARTITIONS,
+                        help="routing partitions for bids and auction ends; must match on every component")
+
+def partition_for(auction_id, partitions=PARTITIONS):
+    # crc32, unlike hash(), is the same in every process and every run
+    return zlib.crc32(str(auction_id).encode('utf-8')) % partitions
+
+def partitioned_key(event, auction_id, partitions=PARTITIONS):
+    if partitions <= 1:
+        return event
+    return f"{event}.{partition_for(auction_id, partitions)}"
+
+def event_of(routing_key):
+    # 'bid_placed.7' -> 'bid_placed'
+    return routing_key.split('.', 1)[0]
+
+def declare_exchanges(channel=None):
+    channel = channel or get_channel()
     channel.exchange_declare(exchange='auction_fanout_exchange', exchange_type='fanout')
     channel.exchange_declare(exchange='direct_exchange', exchange_type='direct')
-    connection.close()
+
+def call_later(connection, delay, callback):
+    # BlockingConnection schedules on itself, the asyncio adapter on its event loop
+    if isinstance(connection, AsyncioConnection):
+        return connection.ioloop.call_later(delay, callback)
+    return connection.call_later(delay, callback)
+
+def consume_forever(setup):
+    # setup(connection, channel) declares/binds/consumes; it runs again after every reconnect
+    delay = RECONNECT_DELAY
+    while True:
+        try:
+            connection = get_connection()
+            channel = get_channel()
+            setup(connection, channel)
+            delay = RECONNECT_DELAY
+            channel.start_consuming()
+            return
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+            logger.warning(f"Lost connection to RabbitMQ ({e}). Reconnecting in {delay:.0f}s.")
+            reset_connection()
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+
+async def connect_async():
+    # returns (connection, channel, closed): closed resolves with the reason once the connection is gone
+    loop = asyncio.get_running_loop()
+    opened = loop.create_future()
+    closed = loop.create_future()
+
+    def on_open_error(connection, error):
+        if not opened.done():
+            opened.set_exception(error if isinstance(error, BaseException)
+                                 else pika.exceptions.AMQPConnectionError(error))
+
+    def on_close(connection, reason):
+        if not opened.done():
+            on_open_error(connection, reason)
+        if not closed.done():
+            closed.set_result(reason)
+
+    connection = AsyncioConnection(
+        pika.ConnectionParameters(host=HOST),
+        on_open_callback=lambda conn: opened.done() or opened.set_result(conn),
+        on_open_error_callback=on_open_error,
+        on_close_callback=on_close,
+        custom_ioloop=loop)
+    await opened
+
+    channel_opened = loop.create_future()
+    channel = connection.channel(on_open_callback=channel_opened.set_result)
+    await channel_opened
+    # a channel closed by the broker takes the connection down, which triggers a reconnect
+    channel.add_on_close_callback(lambda ch, reason: connection.is_open and connection.close())
+    return connection, channel, closed
+
+async def acall(method, *args, **kwargs):
+    # awaits a callback-style pika channel method, e.g. await acall(channel.queue_declare, queue='x')
+    future = asyncio.get_running_loop().create_future()
+    method(*args, callback=lambda frame: future.done() or future.set_result(frame), **kwargs)
+    return await future
+
+async def declare_exchanges_async(channel):
+    await acall(channel.exchange_declare, exchange='auction_fanout_exchange', exchange_type='fanout')
+    await acall(channel.exchange_declare, exchange='direct_exchange', exchange_type='direct')
+
+async def consume_forever_async(setup):
+    # asyncio counterpart of consume_forever: await setup(connection, channel) after every (re)connect
+    delay = RECONNECT_DELAY
+    while True:
+        try:
+            connection, channel, closed = await connect_async()
+            await setup(connection, channel)
+            delay = RECONNECT_DELAY
+            reason = await closed
+            logger.warning(f"Lost connection to RabbitMQ ({reason}). Reconnecting in {delay:.0f}s.")
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+            logger.warning(f"Could not connect to RabbitMQ ({e}). Retrying in {delay:.0f}s.")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+
+class Publisher:
+    # Buffered publisher shared by every component.
+    # Bound to a channel (consumers), publish() only buffers and flush() sends the batch on
+    # that channel from the consumer's own thread. Unbound (ms_auction, client), publish()
+    # is a thread-safe enqueue and a background thread with its own long-lived connection
+    # sends the messages, so no caller ever pays for connection setup. With a journal, a
+    # bound publisher fsyncs it before sending, so no event is announced before it is durable.
+    def __init__(self, channel=None, batch_size=PUBLISH_BATCH_SIZE, flush_interval=PUBLISH_FLUSH_INTERVAL, journal=None):
+        self.channel = channel
+        self.journal = journal
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.published = 0
+        self._buffer = []
+        self._queue = None
+        self._thread = None
+        if channel is None:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name="publisher", daemon=True)
+            self._thread.start()
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        message = (exchange, routing_key, body, properties)
+        if self._queue is not None:
+            self._queue.put(message)
+            return
+        self._buffer.append(message)
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._queue is not None:
+            # wait until the background thread has sent everything enqueued so far
+            self._queue.join()
+            return
+        buffer, self._buffer = self._buffer, []
+        if buffer and self.journal is not None:
+            self.journal.commit()
+        for exchange, routing_key, body, properties in buffer:
+            self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+        self.published += len(buffer)
+
+    def close(self):
+        if self._queue is None:
+            self.flush()
+            return
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        pending = []
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                stopping = True
+            elif item is not False:
+                pending.append(item)
+            # drain whatever else is already waiting into the same burst
+            while not stopping and len(pending) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                pending.append(item)
+
+            if pending:
+                self._send(pending)
+                for _ in pending:
+                    self._queue.task_done()
+                pending = []
+            else:
+                # keep heartbeats flowing while idle
+                connection = getattr(_local, 'connection', None)
+                if connection is not None and connection.is_open:
+                    connection.process_data_events(time_limit=0)
+            if stopping:
+                self._queue.task_done()
+        reset_connection()
+
+    def _send(self, messages):
+        while True:
+            try:
+                channel = get_channel()
+                for exchange, routing_key, body, properties in messages:
+                    channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+                self.published += len(messages)
+                return
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+                # resend the whole burst on a fresh connection (at-least-once)
+                logger.warning(f"Publish failed ({e}). Reconnecting.")
+                reset_connection()
+                time.sleep(RECONNECT_DELAY)
+
+class AckBatcher:
+    # Manual-ack consumption: handlers mark deliveries done (in any order) and the highest
+    # contiguous tag is acked with multiple=True every batch_size messages or interval_ms.
+    # The channel runs in tx mode so the publishes made for a batch are confirmed by the
+    # broker in the same round trip as its ack (confirm_delivery on the blocking adapter
+    # waits on every single publish). With a journal, the batch's log records are fsynced
+    # before anything is published or acked (group commit).
+    def __init__(self, connection, channel, prefetch=PREFETCH_COUNT,
+                 batch_size=ACK_BATCH_SIZE, interval_ms=ACK_BATCH_INTERVAL_MS, publisher=None, journal=None):
+        if batch_size > prefetch:
+            # acks only reach the broker on commit, a batch larger than the window would stall
+            logger.warning(f"Ack batch {batch_size} larger than prefetch {prefetch}; using {prefetch}.")
+            batch_size = prefetch
+        self.connection = connection
+        self.channel = channel
+        self.publisher = publisher
+        self.journal = journal
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000.0
+        self.watermark = 0
+        self.acked = 0
+        self._done_ahead = set()
+
+        channel.basic_qos(prefetch_count=prefetch)
+        channel.tx_select()
+        call_later(connection, self.interval, self._tick)
+
+    def done(self, delivery_tag):
+        if delivery_tag != self.watermark + 1:
+            self._done_ahead.add(delivery_tag)
+            return
+        self.watermark = delivery_tag
+        while self.watermark + 1 in self._done_ahead:
+            self._done_ahead.remove(self.watermark + 1)
+            self.watermark += 1
+        if self.watermark - self.acked >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.watermark == self.acked:
+            return
+        if self.journal is not None:
+            self.journal.commit()
+        if self.publisher is not None:
+            # the batch's own publishes must be part of the same commit
+            self.publisher.flush()
+        self.channel.basic_ack(delivery_tag=self.watermark, multiple=True)
+        self.channel.tx_commit()
+        self.acked = self.watermark
+
+    def _tick(self):
+        if self.channel.is_open:
+            self.flush()
+            call_later(self.connection, self.interval, self._tick)
+
+
+def add_ack_arguments(parser):
+    parser.add_argument("--manual-ack", action="store_true",
+                        help="ack in batches after processing instead of auto_ack")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_COUNT)
+    parser.add_argument("--ack-batch", type=int, default=ACK_BATCH_SIZE)
+    parser.add_argument("--ack-interval-ms", type=int, default=ACK_BATCH_INTERVAL_MS)
 
 def main():
     declare_exchanges()
+    reset_connection()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -11,12 +11,18 @@ quando o tempo definido para esse leilão expirar. Quando um leilão
 termina, ele publica o evento na fila: leilao_finalizado.
 """
 
-import pika
 import json
+import csv
+import sys
 import time
+import heapq
+import argparse
+import itertools
 from datetime import datetime, timedelta
 import threading
 from loguru import logger
+import middleware
+import wire
 
 auctions = [
     {
@@ -35,13 +41,12 @@ auctions = [
     }
 ]
 
-def connect_to_rabbitmq():
-    connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-    channel = connection.channel()
-    return connection, channel
+# shared by the scheduling threads; owns the only connection of this service
+publisher = None
+content_type = wire.DEFAULT_FORMAT
+partitions = middleware.PARTITIONS
 
 def publish_auction_start(auction):
-    connection, channel = connect_to_rabbitmq()
     event = {
         "id": auction["id"],
         "description": auction["description"],
@@ -49,49 +54,188 @@ def publish_auction_start(auction):
         "end_time": auction["end_time"].isoformat(),
         "status": auction["status"]
     }
-    channel.basic_publish(
+    publisher.publish(
         exchange='auction_fanout_exchange',
         routing_key='',
-        body=json.dumps(event)
+        body=wire.encode(wire.AUCTION_STARTED, event, content_type),
+        properties=middleware.properties_for(content_type)
     )
     logger.info(f" [x] Published start event for auction {auction['id']} - {auction['description']}")
-    connection.close()
 
 def publish_auction_end(auction):
-    connection, channel = connect_to_rabbitmq()
     event = {
         "id": auction["id"],
         "description": auction["description"],
         "end_time": auction["end_time"].isoformat(),
         "status": "finished"
     }
-    channel.basic_publish(
+    publisher.publish(
         exchange='direct_exchange',
-        routing_key='auction_ended',
-        body=json.dumps(event)
+        routing_key=middleware.partitioned_key('auction_ended', auction["id"], partitions),
+        body=wire.encode(wire.AUCTION_ENDED, event, content_type),
+        properties=middleware.properties_for(content_type)
     )
     logger.info(f" [x] Published end event for auction {auction['id']} - {auction['description']}")
-    connection.close()
-
-def schedule_auction_events():    
-    current_time = datetime.now()
-    for auction in auctions:
-        start_delay = (auction["start_time"] - current_time).total_seconds()
-        if start_delay > 0:
-            threading.Timer(start_delay, publish_auction_start, args=(auction,)).start()
-        else:
-            publish_auction_start(auction)
-            
-        end_delay = (auction["end_time"] - current_time).total_seconds()
-        if end_delay > 0:
-            threading.Timer(end_delay, publish_auction_end, args=(auction,)).start()
+
+# only start events due within this many seconds are read from the catalog and kept in memory
+CATALOG_LOOKAHEAD = 60.0
+
+def parse_time(value, now=None):
+    # ISO timestamps, or a number of seconds from now (handy for test catalogs)
+    if isinstance(value, datetime):
+        return value
+    try:
+        return (now or datetime.now()) + timedelta(seconds=float(value))
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(value)
+
+def to_auction(entry, now=None):
+    return {
+        "id": str(entry["id"]),
+        "description": entry.get("description", ""),
+        "start_time": parse_time(entry["start_time"], now),
+        "end_time": parse_time(entry["end_time"], now),
+        "status": entry.get("status") or "active"
+    }
+
+def load_catalog(path):
+    # streams auctions one at a time from a CSV file or a JSON lines file (one auction per line)
+    now = datetime.now()
+    with open(path, newline='') as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield to_auction(row, now)
         else:
-            publish_auction_end(auction)
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield to_auction(json.loads(line), now)
+
+
+class AuctionScheduler:
+    # One thread and a heap of (due time, seq, kind, auction) instead of two Timer threads per
+    # auction. The catalog is consumed lazily (expected in start_time order), so the heap only
+    # holds the look-ahead window plus the end events of running auctions.
+    def __init__(self, catalog=(), lookahead=CATALOG_LOOKAHEAD):
+        self.lookahead = lookahead
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._catalog = iter(catalog)
+        self._next_entry = None
+        self._last_catalog_start = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="auction-scheduler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def add_auction(self, auction):
+        with self._cond:
+            self._push(auction["start_time"], "start", auction)
+            self._cond.notify()
+
+    def _push(self, when, kind, auction):
+        heapq.heappush(self._heap, (when.timestamp(), next(self._seq), kind, auction))
+
+    def _refill(self, now):
+        horizon = now + self.lookahead
+        while self._catalog is not None:
+            if self._next_entry is None:
+                self._next_entry = next(self._catalog, None)
+                if self._next_entry is None:
+                    self._catalog = None
+                    return
+            start = self._next_entry["start_time"].timestamp()
+            if start > horizon:
+                return
+            if self._last_catalog_start is not None and start < self._last_catalog_start:
+                logger.warning(f"Catalog not sorted by start_time at auction {self._next_entry['id']}; it may start late.")
+            self._last_catalog_start = start
+            self._push(self._next_entry["start_time"], "start", self._next_entry)
+            self._next_entry = None
+
+    def _next_wakeup(self, now):
+        wakeups = []
+        if self._heap:
+            wakeups.append(self._heap[0][0])
+        if self._next_entry is not None:
+            wakeups.append(self._next_entry["start_time"].timestamp() - self.lookahead)
+        return max(0.0, min(wakeups) - now) if wakeups else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                now = time.time()
+                self._refill(now)
+                burst = []
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, kind, auction = heapq.heappop(self._heap)
+                    burst.append((kind, auction))
+                if not burst:
+                    self._cond.wait(self._next_wakeup(now))
+                    continue
+                for kind, auction in burst:
+                    if kind == "start":
+                        self._push(auction["end_time"], "end", auction)
+
+            # everything due in this tick goes to the publisher together and leaves in one burst
+            for kind, auction in burst:
+                if kind == "start":
+                    publish_auction_start(auction)
+                else:
+                    publish_auction_end(auction)
+
+
+def schedule_auction_events(catalog=None):
+    scheduler = AuctionScheduler(catalog if catalog is not None else sorted(auctions, key=lambda a: a["start_time"]))
+    scheduler.start()
+    return scheduler
+
+def watch_stdin(scheduler):
+    # new auctions at runtime: one JSON object per line, same fields as the catalog
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            auction = to_auction(json.loads(line))
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Invalid auction '{line}': {e}")
+            continue
+        scheduler.add_auction(auction)
+        logger.info(f"Auction {auction['id']} scheduled for {auction['start_time'].isoformat()}")
 
 def main():
-    schedule_auction_events()
-    while True:
-        time.sleep(1)
+    global publisher, content_type, partitions
+
+    parser = argparse.ArgumentParser(description="MS Leilão")
+    parser.add_argument("--catalog", help="auction catalog (.csv or JSON lines), sorted by start_time")
+    parser.add_argument("--stdin", action="store_true", help="read extra auctions as JSON lines from stdin")
+    middleware.add_wire_argument(parser)
+    middleware.add_partition_argument(parser)
+    args = parser.parse_args()
+    content_type = wire.CONTENT_TYPES[args.wire]
+    partitions = args.partitions
+
+    publisher = middleware.Publisher()
+    scheduler = schedule_auction_events(load_catalog(args.catalog) if args.catalog else None)
+    try:
+        if args.stdin:
+            watch_stdin(scheduler)
+        while True:
+            time.sleep(1)
+    finally:
+        scheduler.stop()
+        publisher.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -17,168 +17,972 @@ negociado. O vencedor é o que efetuou o maior lance válido até o
 encerramento.
 """
 
-import pika
-import json
+import os
+import time
+import argparse
+import asyncio
+import functools
+import heapq
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from loguru import logger
-from typing import List
+from typing import Dict, Optional
 from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
-from Crypto.Hash import SHA256
-import base64
-
-connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-channel = connection.channel()
+import history
+import journal as journal_log
+import metrics
+import middleware
+import signatures
+import wire
+
+# set up by main() on the consumer thread, again after every reconnect
+connection = None
+channel = None
+publisher = None
+
+KEYS_DIR = "keys"
+KEY_CACHE_SIZE = 1024
+# how long a cached key is trusted before its file is stat'ed again
+KEY_REVALIDATE_SECONDS = 1.0
+# how long an unknown user is remembered before the disk is checked again
+KEY_NEGATIVE_TTL_SECONDS = 5.0
+# signature verification pool; 0 workers keeps everything on the consumer thread
+VERIFY_WORKERS = 0
+VERIFY_POOL = 'process'
+# replays and redeliveries: a bid id is remembered for BID_WINDOW_SECONDS after its timestamp,
+# bids older than that (or further ahead than the allowed skew) are refused outright
+BID_WINDOW_SECONDS = 300
+BID_CLOCK_SKEW_SECONDS = 30
+DUPLICATE_FILTER_SIZE = 200000
+# publish the best price of an auction on price_<auction_id> after every accepted bid
+PRICE_FEED = True
+# write-ahead log + snapshots of the auction state, kept only when --state-dir is given; fsynced
+# once per ack batch, or every JOURNAL_COMMIT_MS without --manual-ack. Without it ended auctions
+# still spill their bid histories under STATE_DIR
+STATE_DIR = os.path.join("state", "ms_bid")
+JOURNAL_COMMIT_MS = 50
+
+
+class PublicKeyCache:
+    def __init__(self, keys_dir=KEYS_DIR, max_size=KEY_CACHE_SIZE,
+                 revalidate_seconds=KEY_REVALIDATE_SECONDS, negative_ttl=KEY_NEGATIVE_TTL_SECONDS):
+        self.keys_dir = keys_dir
+        self.max_size = max_size
+        self.revalidate_seconds = revalidate_seconds
+        self.negative_ttl = negative_ttl
+        # user_id -> (key, mtime_ns, size, checked_at), oldest first
+        self._entries = OrderedDict()
+        # user_id -> time the missing key was last seen
+        self._missing = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.evictions = 0
+        # the asyncio mode looks keys up from executor threads
+        self._lock = threading.Lock()
+
+    def path_for(self, user_id):
+        return os.path.join(self.keys_dir, f"{user_id}_public.pem")
+
+    def get(self, user_id):
+        # returns the RSA key, or raises FileNotFoundError / ValueError like the plain file read did
+        with self._lock:
+            return self._get(user_id)
+
+    def _get(self, user_id):
+        now = time.monotonic()
+
+        missing_since = self._missing.get(user_id)
+        if missing_since is not None:
+            if now - missing_since < self.negative_ttl:
+                self.negative_hits += 1
+                raise FileNotFoundError(self.path_for(user_id))
+            del self._missing[user_id]
+
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            key, mtime_ns, size, checked_at = entry
+            if now - checked_at < self.revalidate_seconds:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return key
+            try:
+                st = os.stat(self.path_for(user_id))
+            except FileNotFoundError:
+                # the client deleted its key on exit
+                self.invalidate(user_id)
+                self._remember_missing(user_id, now)
+                self.misses += 1
+                raise
+            if st.st_mtime_ns == mtime_ns and st.st_size == size:
+                self._entries[user_id] = (key, mtime_ns, size, now)
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return key
+
+        self.misses += 1
+        return self._load(user_id, now)
+
+    def _load(self, user_id, now):
+        path = self.path_for(user_id)
+        try:
+            with open(path, "rb") as f:
+                st = os.fstat(f.fileno())
+                key = RSA.import_key(f.read())
+        except FileNotFoundError:
+            self.invalidate(user_id)
+            self._remember_missing(user_id, now)
+            raise
+
+        self._entries[user_id] = (key, st.st_mtime_ns, st.st_size, now)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return key
+
+    def _remember_missing(self, user_id, now):
+        self._missing[user_id] = now
+        self._missing.move_to_end(user_id)
+        while len(self._missing) > self.max_size:
+            self._missing.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+        self._missing.pop(user_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.negative_hits
+        return {
+            "size": len(self._entries),
+            "missing": len(self._missing),
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
+
+
+key_cache = PublicKeyCache()
+
+
+class DuplicateFilter:
+    # Time-windowed set of verified bid ids. Memory is capped at max_size: when it is full the
+    # ids with the oldest timestamps are evicted and raise `floor`, at or below which bids are
+    # refused as stale, so an evicted id can never be replayed successfully. Evicting by timestamp
+    # rather than arrival keeps a bid from a fast client clock from pushing the floor past the
+    # timestamps of honest bids.
+    def __init__(self, window=BID_WINDOW_SECONDS, max_size=DUPLICATE_FILTER_SIZE, skew=BID_CLOCK_SKEW_SECONDS):
+        self.window = window
+        self.max_size = max_size
+        self.skew = skew
+        self.floor = 0.0
+        # bid_id -> timestamp, and a min-heap of (timestamp, bid_id) over the same ids
+        self._seen = {}
+        self._by_time = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def check(self, bid_id, timestamp, now=None):
+        # cheap pre-verification test; returns the rejection reason or None
+        now = time.time() if now is None else now
+        if timestamp < now - self.window or timestamp <= self.floor or timestamp > now + self.skew:
+            return "stale"
+        if bid_id in self._seen:
+            return "duplicate"
+        return None
+
+    def add(self, bid_id, timestamp, now=None):
+        # records a verified id; False if it was already there
+        now = time.time() if now is None else now
+        with self._lock:
+            if bid_id in self._seen:
+                return False
+            self._seen[bid_id] = timestamp
+            heapq.heappush(self._by_time, (timestamp, bid_id))
+            horizon = now - self.window
+            while self._by_time:
+                oldest_ts, oldest_id = self._by_time[0]
+                if oldest_ts >= horizon and len(self._seen) <= self.max_size:
+                    break
+                heapq.heappop(self._by_time)
+                del self._seen[oldest_id]
+                if oldest_ts >= horizon:
+                    self.floor = max(self.floor, oldest_ts)
+            return True
+
+    def items(self):
+        with self._lock:
+            return list(self._seen.items())
+
+
+duplicates = DuplicateFilter()
 
 class Auction:
+    __slots__ = ("auction_id", "description", "start_time", "end_time", "status",
+                 "bids", "highest_bid", "highest_bidder")
+
     def __init__(self, auction_id, description, start_time, end_time, status):
         self.auction_id = auction_id
         self.description = description
         self.start_time = start_time
         self.end_time = end_time
         self.status = status
-        self.bids = [] 
+        # columnar while the auction runs, a history.SpilledHistory file once it has ended
+        self.bids = history.BidHistory()
         self.highest_bid = 0.0
         self.highest_bidder = None
 
 
-auctions: List[Auction] = []
-
-def handle_auction_started(body):
-    logger.info("Received auction started event")
-    auction_data = json.loads(body)
+# how many ended auctions are kept around to answer late bids/end events
+MAX_ENDED_AUCTIONS = 1000
+
+
+class AuctionRegistry:
+    def __init__(self, max_ended=MAX_ENDED_AUCTIONS):
+        self.max_ended = max_ended
+        # auction_id -> Auction, for every known auction (active or still archived)
+        self._by_id: Dict[str, Auction] = {}
+        self.active: Dict[str, Auction] = {}
+        # ended auctions, oldest first, dropped once max_ended is exceeded
+        self.ended: "OrderedDict[str, Auction]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, auction_id):
+        return auction_id in self._by_id
+
+    def __iter__(self):
+        return iter(self._by_id.values())
+
+    def get(self, auction_id) -> Optional[Auction]:
+        return self._by_id.get(auction_id)
+
+    def add(self, auction: Auction):
+        self._by_id[auction.auction_id] = auction
+        self.ended.pop(auction.auction_id, None)
+        if auction.status == 'active':
+            self.active[auction.auction_id] = auction
+        else:
+            self.active.pop(auction.auction_id, None)
+
+    def end(self, auction_id) -> Optional[Auction]:
+        auction = self._by_id.get(auction_id)
+        if auction is None:
+            return None
+        auction.status = 'ended'
+        self.active.pop(auction_id, None)
+        self.ended[auction_id] = auction
+        self.ended.move_to_end(auction_id)
+        while len(self.ended) > self.max_ended:
+            old_id, old = self.ended.popitem(last=False)
+            del self._by_id[old_id]
+            if isinstance(old.bids, history.SpilledHistory):
+                # nothing refers to its bid history file any more
+                old.bids.discard()
+        return auction
+
+
+auctions = AuctionRegistry()
+verifier = None
+acker = None
+journal = None
+# ended auctions' bid histories are moved here; None keeps them in memory
+history_dir = os.path.join(STATE_DIR, "history")
+price_feed = PRICE_FEED
+args = None
+
+# sharded mode: this instance owns the auctions whose partition is in owned_partitions
+queue_name = 'ms_bid_queue'
+partitions = middleware.PARTITIONS
+owned_partitions = None
+
+def configure_shard(n_partitions, shard, shards):
+    global queue_name, partitions, owned_partitions
+    if not 0 <= shard < shards <= max(n_partitions, 1):
+        raise ValueError(f"shard {shard} of {shards} needs 0 <= shard < shards <= partitions ({n_partitions})")
+    partitions = n_partitions
+    owned_partitions = {p for p in range(n_partitions) if p % shards == shard} if n_partitions > 1 else None
+    # one queue per shard keeps every auction's bids in a single ordered stream
+    queue_name = f"ms_bid_queue.{shard}" if shards > 1 else 'ms_bid_queue'
+
+def owns(auction_id):
+    return owned_partitions is None or middleware.partition_for(auction_id, partitions) in owned_partitions
+
+def routing_keys():
+    # state queries reach every shard; each one answers for the auctions it owns
+    if owned_partitions is None:
+        return ['bid_placed', 'auction_ended', 'state_query']
+    return [f"{event}.{p}" for p in sorted(owned_partitions) for event in ('bid_placed', 'auction_ended')] + ['state_query']
+
+def log_event(record):
+    if journal is not None:
+        journal.append(record)
+
+def spill_history(auction):
+    if history_dir is None or not isinstance(auction.bids, history.BidHistory):
+        return
+    os.makedirs(history_dir, exist_ok=True)
+    auction.bids = auction.bids.spill(history.path_for(history_dir, auction.auction_id))
+
+def snapshot_state():
+    # ended auctions last and oldest first, so restoring them keeps the archive's eviction order
+    ordered = list(auctions.active.values()) + list(auctions.ended.values())
+    entries = []
+    for a in ordered:
+        entry = {"id": a.auction_id, "description": a.description, "start_time": a.start_time,
+                 "end_time": a.end_time, "status": a.status,
+                 "highest_bid": a.highest_bid, "highest_bidder": a.highest_bidder}
+        if isinstance(a.bids, history.BidHistory):
+            entry["bids"] = a.bids.columns()
+        else:
+            entry["spilled"] = True
+        entries.append(entry)
+    return {"auctions": entries, "bid_ids": duplicates.items()}
+
+def restore_snapshot(state):
+    for entry in state['auctions']:
+        auction = Auction(entry['id'], entry['description'], entry['start_time'], entry['end_time'], 'active')
+        auctions.add(auction)
+        if entry.get('spilled'):
+            try:
+                auction.bids = history.SpilledHistory(history.path_for(history_dir, entry['id']))
+            except (OSError, ValueError) as e:
+                logger.warning("Bid history of auction {} is unavailable: {}", entry['id'], e)
+        else:
+            bids = entry['bids']
+            for user_id, amount, timestamp in zip(bids['users'], bids['amounts'], bids['timestamps']):
+                auction.bids.append(user_id, amount, timestamp)
+        auction.highest_bid, auction.highest_bidder = entry['highest_bid'], entry['highest_bidder']
+        if entry['status'] != 'active':
+            replay_event({"op": "end", "id": entry['id']})
+    for bid_id, timestamp in state.get('bid_ids', ()):
+        duplicates.add(bid_id, timestamp)
+
+def replay_event(record):
+    op = record['op']
+    if op == 'start':
+        auctions.add(Auction(record['id'], record['description'], record['start_time'], record['end_time'], record['status']))
+    elif op == 'bid':
+        if record.get('bid_id') is not None:
+            duplicates.add(record['bid_id'], record['timestamp'])
+        auction = auctions.get(record['auction_id'])
+        if auction is not None:
+            auction.bids.append(record['user_id'], record['bid_amount'], record.get('timestamp'))
+            auction.highest_bid = record['bid_amount']
+            auction.highest_bidder = record['user_id']
+    elif op == 'end':
+        auction = auctions.end(record['id'])
+        if auction is not None:
+            spill_history(auction)
+
+def recover_state(state_dir, snapshot_every=journal_log.SNAPSHOT_EVERY):
+    global journal
+    start = time.perf_counter()
+    journal = journal_log.Journal(state_dir, snapshot_every, state_fn=snapshot_state)
+    state, records = journal.recover()
+    if state is not None:
+        restore_snapshot(state)
+    for record in records:
+        replay_event(record)
+    logger.info("Recovered {} auctions ({} active) in {:.3f}s", len(auctions), len(auctions.active), time.perf_counter() - start)
+
+def commit_tick(conn):
+    # group commit when there is no ack batch to piggyback on; stops once a reconnect replaced conn
+    if conn is connection and journal is not None:
+        journal.commit()
+        publisher.flush()
+        middleware.call_later(conn, JOURNAL_COMMIT_MS / 1000.0, functools.partial(commit_tick, conn))
+
+def drop_malformed(event, error):
+    # a bad or old-format event is logged and dropped; it must not take the consumer down
+    logger.warning("Malformed {} event: {}. Message dropped.", event, error)
+    metrics.registry.inc(f"events_dropped.{event}")
+
+def handle_auction_started(body, content_type=None):
+    logger.debug("Received auction started event")
+    try:
+        auction_data = wire.decode(body, content_type)
+        auction = Auction(
+            auction_id=auction_data['id'],
+            description=auction_data['description'],
+            start_time=auction_data['start_time'],
+            end_time=auction_data['end_time'],
+            status=auction_data['status']
+        )
+    except (wire.WireError, ValueError, KeyError, TypeError) as e:
+        drop_malformed("auction_started", e)
+        return
+    if not owns(auction.auction_id):
+        # start events are broadcast; another shard owns this auction
+        logger.debug("Auction {} belongs to another shard", auction.auction_id)
+        return
 
-    auction = Auction(
-        auction_id=auction_data['id'],
-        description=auction_data['description'],
-        start_time=auction_data['start_time'],
-        end_time=auction_data['end_time'],
-        status=auction_data['status']
-    )
+    existing = auctions.get(auction.auction_id)
+    if existing is not None and existing.status == 'active':
+        if existing.start_time == auction.start_time:
+            logger.warning("Auction {} already registered. Start event ignored.", auction.auction_id)
+            return
+        # ms_auction reuses its ids across runs: a recovered auction must not carry its old bids into a new one
+        logger.warning("Auction {} restarted at {}; state from {} discarded.", auction.auction_id,
+                       auction.start_time, existing.start_time)
 
-    auctions.append(auction)
-    logger.info(f"Auction created: {auction.auction_id} - {auction.description}")
+    auctions.add(auction)
+    log_event({"op": "start", "id": auction.auction_id, "description": auction.description,
+               "start_time": auction.start_time, "end_time": auction.end_time, "status": auction.status})
+    logger.info("Auction created: {} - {}", auction.auction_id, auction.description)
 
 def accept_bid(bid: dict, auction: Auction):
-    auction.bids.append(bid)
+    auction.bids.append(bid['user_id'], bid['bid_amount'], bid['timestamp'])
     auction.highest_bid = bid['bid_amount']
     auction.highest_bidder = bid['user_id']
-    logger.info(f"Bid accepted: Auction ID {auction.auction_id}, User ID {bid['user_id']}, Amount {bid['bid_amount']}")
+    log_event({"op": "bid", "auction_id": auction.auction_id, "user_id": bid['user_id'], "bid_amount": bid['bid_amount'],
+               "bid_id": bid['bid_id'], "timestamp": bid['timestamp']})
+    logger.debug("Bid accepted: Auction ID {}, User ID {}, Amount {}", auction.auction_id, bid['user_id'], bid['bid_amount'])
 
-def handle_bid_placed(body):
-    logger.info("Received bid placed event")
-    bid_data = json.loads(body)
-    # body: {"auction_id": "123", "user_id": "456", "bid_amount": 100.0, "signature": "abc123"}
+def parse_bid(body, content_type=None, admit_first=True):
+    # decodes the bid and gathers what verification needs; returns None if rejected up front.
+    # Per-bid outcomes are DEBUG lines: a contested auction rejects most bids, the counters say how many
+    try:
+        bid_data, message, signature = wire.decode_signed_bid(body, content_type)
+    except (wire.WireError, ValueError) as e:
+        # also covers missing or mistyped fields (including bid_id/timestamp), checked by wire
+        logger.debug("Malformed bid: {}. Bid rejected.", e)
+        metrics.registry.inc("bids_rejected.malformed")
+        return None
+    # body: {"auction_id": "123", "user_id": "456", "bid_amount": 100.0, "bid_id": "9f2c...", "timestamp": 1759312800.0, "signature": "abc123"}
+    # (or the same fields in the binary wire format, signature last over the bytes before it)
+
+    # replays and bids that can't win are dropped here, before the key lookup and the signature check;
+    # admit_first=False when earlier messages may not have been applied yet (asyncio mode)
+    reason = duplicates.check(bid_data['bid_id'], bid_data['timestamp']) or (admit(bid_data) if admit_first else None)
+    if reason is not None:
+        logger.debug("Bid {} from {} is {}. Bid rejected.", bid_data['bid_id'], bid_data['user_id'], reason)
+        metrics.registry.inc(f"bids_rejected.{reason}")
+        metrics.registry.inc("bids_rejected_before_verify")
+        return None
 
     # Only accepts if the signature is valid;
     # All clients public keys are stored in the 'keys' folder as {user_id}_public.pem
 
     try:
-        with open(f"keys/{bid_data['user_id']}_public.pem", "rb") as f:
-            public_key = RSA.import_key(f.read())
+        public_key = key_cache.get(bid_data['user_id'])
     except FileNotFoundError:
-        logger.warning(f"Public key for user {bid_data['user_id']} not found. Bid rejected.")
-        return
+        logger.debug("Public key for user {} not found. Bid rejected.", bid_data['user_id'])
+        metrics.registry.inc("bids_rejected.unknown_user")
+        return None
     except(ValueError, IndexError, TypeError) as e:
-        logger.warning(f"Error loading public key for user {bid_data['user_id']}: {e}. Bid rejected.")
-        return
-    
-    sig_b64 = bid_data.pop('signature')
-    try:
-        signature = base64.b64decode(sig_b64)
-    except (base64.binascii.Error, ValueError) as e:
-        logger.warning(f"Invalid base64 signature for user {bid_data['user_id']}: {e}. Bid rejected.")
+        logger.debug("Error loading public key for user {}: {}. Bid rejected.", bid_data['user_id'], e)
+        metrics.registry.inc("bids_rejected.bad_key")
+        return None
+
+    return bid_data, message, signature, public_key
+
+def admit(bid_data):
+    # cheap state checks ahead of the crypto; apply_bid repeats them, the state may move on
+    # while the signature is being checked
+    if verifier is not None and verifier.starting.get(bid_data['auction_id']):
+        # a queued start event will replace this auction's state before the bid is applied
+        return None
+    auction = auctions.get(bid_data['auction_id'])
+    if auction is None:
+        return "unknown_auction"
+    if auction.status != 'active':
+        return "inactive"
+    if bid_data['bid_amount'] <= auction.highest_bid:
+        return "too_low"
+    return None
+
+def publish_price(auction, content_type):
+    publisher.publish(
+        exchange='direct_exchange',
+        routing_key=f"price_{auction.auction_id}",
+        body=wire.encode(wire.PRICE, {"auction_id": auction.auction_id, "highest_bid": auction.highest_bid}, content_type),
+        properties=middleware.properties_for(content_type)
+    )
+
+def apply_bid(bid_data: dict, signature_valid: bool, content_type=None):
+    if not signature_valid:
+        logger.debug("Invalid signature for user {}. Bid rejected.", bid_data['user_id'])
+        metrics.registry.inc("bids_rejected.bad_signature")
         return
-    
-    signed_dict = {k: v for k, v in bid_data.items() if k != 'signature'}
-    message = json.dumps(signed_dict, separators=(',', ':'), sort_keys=True).encode('utf-8')
-    h = SHA256.new(message)
+    logger.debug("Signature verified for user {}.", bid_data['user_id'])
 
-    try:
-        pkcs1_15.new(public_key).verify(h, signature)
-        logger.info(f"Signature verified for user {bid_data['user_id']}.")
-    except (ValueError, TypeError):
-        logger.warning(f"Invalid signature for user {bid_data['user_id']}. Bid rejected.")
+    # only verified ids are recorded, so a forged copy can't shadow the real bid; this also
+    # catches copies that were verified side by side
+    if not duplicates.add(bid_data['bid_id'], bid_data['timestamp']):
+        logger.debug("Bid {} from {} is duplicate. Bid rejected.", bid_data['bid_id'], bid_data['user_id'])
+        metrics.registry.inc("bids_rejected.duplicate")
         return
 
-    if bid_data['auction_id'] not in [a.auction_id for a in auctions]:
-        logger.warning(f"Auction ID {bid_data['auction_id']} does not exist. Client {bid_data['user_id']} bid rejected.")
+    auction = auctions.get(bid_data['auction_id'])
+    if auction is None:
+        logger.debug("Auction ID {} does not exist. Client {} bid rejected.", bid_data['auction_id'], bid_data['user_id'])
+        metrics.registry.inc("bids_rejected.unknown_auction")
         return
-    
-    auction = next(a for a in auctions if a.auction_id == bid_data['auction_id'])
 
     if auction.status != 'active':
-        logger.warning(f"Auction ID {bid_data['auction_id']} is not active. Client {bid_data['user_id']} bid rejected.")
+        logger.debug("Auction ID {} is not active. Client {} bid rejected.", bid_data['auction_id'], bid_data['user_id'])
+        metrics.registry.inc("bids_rejected.inactive")
         return
     
     if bid_data['bid_amount'] <= auction.highest_bid:
-        logger.warning(f"Bid amount {bid_data['bid_amount']} is not higher than current highest bid {auction.highest_bid}. Client {bid_data['user_id']} bid rejected.")
+        logger.debug("Bid amount {} is not higher than current highest bid {}. Client {} bid rejected.", bid_data['bid_amount'], auction.highest_bid, bid_data['user_id'])
+        metrics.registry.inc("bids_rejected.too_low")
         return
     
     accept_bid(bid_data, auction)
+    metrics.registry.inc("bids_accepted")
 
-    channel.basic_publish(
+    # answered in the format the bid arrived in
+    content_type = content_type or wire.JSON
+    publisher.publish(
         exchange='direct_exchange',
         routing_key='bid_validated',
-        body=json.dumps(bid_data)
+        body=wire.encode(wire.BID_VALIDATED, bid_data, content_type),
+        properties=middleware.properties_for(content_type)
     )
+    if price_feed:
+        publish_price(auction, content_type)
 
-
-def handle_auction_ended(body):
-    logger.info("Received auction ended event")
-    auction_data = json.loads(body)
+def handle_bid_placed(body, content_type=None):
+    logger.debug("Received bid placed event")
+    parsed = parse_bid(body, content_type)
+    if parsed is None:
+        return
+    bid_data, message, signature, public_key = parsed
+    apply_bid(bid_data, signatures.verify(public_key, message, signature), content_type)
+
+
+class ParallelVerifier:
+    # Verifies signatures on a worker pool while applying the results on the consumer
+    # thread in arrival order per auction, so the winner matches the serial mode.
+    def __init__(self, workers, pool=VERIFY_POOL):
+        if pool == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        elif pool == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError(f"Unknown verification pool type: {pool}")
+        self.pool = pool
+        # auction_id -> deque of (future, apply, delivery_tag) in arrival order
+        self.pending: Dict[str, deque] = {}
+        # auction_id -> start events received but not applied yet
+        self.starting: Dict[str, int] = {}
+
+    def verify(self, public_key, message: bytes, signature: bytes) -> Future:
+        if self.pool == 'process':
+            return self.executor.submit(signatures.verify_with_numbers, public_key.n, public_key.e, message, signature)
+        return self.executor.submit(signatures.verify, public_key, message, signature)
+
+    def submit(self, auction_id, future: Future, apply, delivery_tag=None):
+        queue = self.pending.get(auction_id)
+        if queue is None and future.done():
+            # nothing ahead of it for this auction
+            self._apply(apply, future, delivery_tag)
+            return
+        if queue is None:
+            queue = self.pending[auction_id] = deque()
+        queue.append((future, apply, delivery_tag))
+        # completion callbacks run on pool threads; hop back to the connection's thread
+        future.add_done_callback(
+            lambda _: connection.add_callback_threadsafe(functools.partial(self.drain, auction_id)))
+
+    def drain(self, auction_id):
+        queue = self.pending.get(auction_id)
+        while queue and queue[0][0].done():
+            future, apply, delivery_tag = queue.popleft()
+            self._apply(apply, future, delivery_tag)
+        if queue is not None and not queue:
+            del self.pending[auction_id]
+
+    def _apply(self, apply, future: Future, delivery_tag):
+        try:
+            apply(future.result())
+        except Exception as e:
+            logger.exception("Error while applying ordered event: {}", e)
+        finally:
+            delivery_done(delivery_tag)
+
+    def reconnected(self, redelivered):
+        if redelivered:
+            # unacked deliveries come back from the broker; their queued results are stale
+            for queue in self.pending.values():
+                for _ in queue:
+                    metrics.registry.finished()
+            self.pending.clear()
+            self.starting.clear()
+            return
+        for auction_id in list(self.pending):
+            connection.add_callback_threadsafe(functools.partial(self.drain, auction_id))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def _done(result=True) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+def dispatch_parallel(method, properties, body):
+    # lifecycle events go through the same per-auction queue so they can't overtake pending bids
+    tag = method.delivery_tag
+    content_type = properties.content_type
+    if method.exchange == 'auction_fanout_exchange':
+        auction_id = event_auction_id("auction_started", body, content_type)
+        if auction_id is None:
+            delivery_done(tag)
+            return
+        verifier.starting[auction_id] = verifier.starting.get(auction_id, 0) + 1
+
+        def start(_):
+            if verifier.starting[auction_id] == 1:
+                del verifier.starting[auction_id]
+            else:
+                verifier.starting[auction_id] -= 1
+            handle_auction_started(body, content_type)
+
+        verifier.submit(auction_id, _done(), start, tag)
+
+    elif middleware.event_of(method.routing_key) == 'bid_placed':
+        logger.debug("Received bid placed event")
+        received_at = time.perf_counter()
+        parsed = parse_bid(body, content_type)
+        if parsed is None:
+            delivery_done(tag)
+            return
+        bid_data, message, signature, public_key = parsed
+        future = verifier.verify(public_key, message, signature)
+
+        def apply(valid):
+            apply_bid(bid_data, valid, content_type)
+            # receipt -> verified -> applied in order behind earlier bids of the same auction
+            metrics.registry.observe("bid_pipeline", time.perf_counter() - received_at)
+
+        verifier.submit(bid_data['auction_id'], future, apply, tag)
+
+    elif middleware.event_of(method.routing_key) == 'auction_ended':
+        auction_id = event_auction_id("auction_ended", body, content_type)
+        if auction_id is None:
+            delivery_done(tag)
+            return
+        verifier.submit(auction_id, _done(), lambda _: handle_auction_ended(body, content_type), tag)
+
+    elif method.routing_key == 'state_query':
+        # a snapshot of what has been applied so far; bids still being verified show up in the price feed
+        handle_state_query(properties)
+        delivery_done(tag)
+
+    else:
+        delivery_done(tag)
+
+def event_auction_id(event, body, content_type):
+    try:
+        return wire.decode(body, content_type)['id']
+    except (wire.WireError, ValueError, KeyError, TypeError) as e:
+        drop_malformed(event, e)
+        return None
+
+def delivery_done(delivery_tag):
+    # a delivery is fully handled: ack it in batch mode, otherwise send what it published right away
+    metrics.registry.finished()
+    if acker is not None:
+        if delivery_tag is not None:
+            acker.done(delivery_tag)
+    elif journal is None:
+        publisher.flush()
+    # with a journal, publishes wait for commit_tick: nothing goes out before its events are fsynced
+
+
+def handle_auction_ended(body, content_type=None):
+    logger.debug("Received auction ended event")
     # body: {"id": "123", "description": "Auction for item X", "start_time": "2023-10-01T10:00:00Z", "end_time": "2023-10-01T12:00:00Z", "status": "ended"}
+    auction_id = event_auction_id("auction_ended", body, content_type)
+    if auction_id is None:
+        return
 
-    auction = next((a for a in auctions if a.auction_id == auction_data['id']), None)
-    if not auction:
-        logger.warning(f"Auction ID {auction_data['id']} not found.")
+    auction = auctions.get(auction_id)
+    if auction is None:
+        logger.warning("Auction ID {} not found.", auction_id)
+        return
+    if auction.status != 'active':
+        logger.warning("Auction ID {} already ended.", auction_id)
         return
 
-    auction.status = 'ended'
-    logger.info(f"Auction ended: {auction.auction_id}. Winner: {auction.highest_bidder} with bid {auction.highest_bid}")
+    auctions.end(auction.auction_id)
+    log_event({"op": "end", "id": auction.auction_id})
+    # the finished history leaves memory; it is read back from disk only when asked for
+    spill_history(auction)
+    logger.info("Auction ended: {}. Winner: {} with bid {}", auction.auction_id, auction.highest_bidder, auction.highest_bid)
+    logger.info("Public key cache stats: {}", key_cache.stats())
 
-    channel.basic_publish(
+    content_type = content_type or wire.JSON
+    publisher.publish(
         exchange='direct_exchange',
         routing_key='auction_winner',
-        body=json.dumps({
+        body=wire.encode(wire.AUCTION_WINNER, {
             "auction_id": auction.auction_id,
             "winner_user_id": auction.highest_bidder,
             "winning_bid_amount": auction.highest_bid
-        })
+        }, content_type),
+        properties=middleware.properties_for(content_type)
+    )
+
+def handle_state_query(properties):
+    logger.debug("Received state query")
+    if not properties.reply_to:
+        logger.warning("State query without reply_to ignored")
+        return
+    rows = [{"id": a.auction_id, "description": a.description, "end_time": a.end_time,
+             "highest_bid": a.highest_bid, "highest_bidder": a.highest_bidder}
+            for a in auctions.active.values()]
+    content_type = properties.content_type or wire.JSON
+    # straight to the client's queue through the default exchange
+    publisher.publish(
+        exchange='',
+        routing_key=properties.reply_to,
+        body=wire.encode_state(rows, content_type),
+        properties=middleware.properties_for(content_type, correlation_id=properties.correlation_id)
     )
+    metrics.registry.inc("state_queries")
 
 def callback(ch, method, properties, body):
-    logger.info(f"Received in routing key {method.routing_key}: \n\t\t{body}")
+    metrics.registry.received()
+    logger.debug("Received in routing key {}: \n\t\t{}", method.routing_key, body)
+
+    logger.debug("\n\nch: {}\nmethod: {}\nproperties: {}\nbody: {}\n\n", ch, method, properties, body)
+
+    if verifier is not None:
+        try:
+            dispatch_parallel(method, properties, body)
+        except Exception:
+            # never handed to the verifier, so nobody else will ack it
+            delivery_done(method.delivery_tag)
+            raise
+        return
 
-    logger.debug(f"\n\nch: {ch}\nmethod: {method}\nproperties: {properties}\nbody: {body}\n\n")
+    try:
+        if method.exchange == 'auction_fanout_exchange':
+            with metrics.registry.timed("handle_auction_started"):
+                handle_auction_started(body, properties.content_type)
+
+        elif middleware.event_of(method.routing_key) == 'bid_placed':
+            with metrics.registry.timed("handle_bid_placed"):
+                handle_bid_placed(body, properties.content_type)
+
+        elif middleware.event_of(method.routing_key) == 'auction_ended':
+            with metrics.registry.timed("handle_auction_ended"):
+                handle_auction_ended(body, properties.content_type)
+
+        elif method.routing_key == 'state_query':
+            handle_state_query(properties)
+    finally:
+        delivery_done(method.delivery_tag)
+
+# asyncio run mode: handlers are coroutines, decoding/key I/O and signature checks run in executors
+verify_executor = None
+# resolves once the previous message has been applied, so state changes keep arrival order
+apply_tail = None
+
+async def wait_turn(turn):
+    if turn is not None:
+        await turn
+
+async def handle_auction_started_async(body, content_type=None, turn=None):
+    await wait_turn(turn)
+    handle_auction_started(body, content_type)
+
+async def handle_bid_placed_async(body, content_type=None, turn=None):
+    logger.debug("Received bid placed event")
+    loop = asyncio.get_running_loop()
+    # admit() would read state that earlier messages still waiting for their turn may change;
+    # apply_bid makes those checks once this bid's turn comes
+    parsed = await loop.run_in_executor(None, parse_bid, body, content_type, False)
+    if parsed is None:
+        return
+    bid_data, message, signature, public_key = parsed
+    if isinstance(verify_executor, ProcessPoolExecutor):
+        valid = await loop.run_in_executor(verify_executor, signatures.verify_with_numbers,
+                                           public_key.n, public_key.e, message, signature)
+    else:
+        valid = await loop.run_in_executor(verify_executor, signatures.verify, public_key, message, signature)
+    await wait_turn(turn)
+    apply_bid(bid_data, valid, content_type)
+
+async def handle_auction_ended_async(body, content_type=None, turn=None):
+    await wait_turn(turn)
+    handle_auction_ended(body, content_type)
+
+async def process_async(method, properties, body, turn, applied, owner):
+    content_type = properties.content_type
+    received_at = time.perf_counter()
+    try:
+        if method.exchange == 'auction_fanout_exchange':
+            await handle_auction_started_async(body, content_type, turn)
+
+        elif middleware.event_of(method.routing_key) == 'bid_placed':
+            await handle_bid_placed_async(body, content_type, turn)
+            metrics.registry.observe("bid_pipeline", time.perf_counter() - received_at)
+
+        elif middleware.event_of(method.routing_key) == 'auction_ended':
+            await handle_auction_ended_async(body, content_type, turn)
+
+        elif method.routing_key == 'state_query':
+            await wait_turn(turn)
+            handle_state_query(properties)
+    except Exception as e:
+        logger.exception("Error while handling message: {}", e)
+    finally:
+        # the next message may only apply after this one, even if this one was rejected early
+        await wait_turn(turn)
+        applied.set_result(None)
+        # tags from before a reconnect mean nothing to the new channel
+        if owner is acker:
+            delivery_done(method.delivery_tag)
+        else:
+            metrics.registry.finished()
+
+def callback_async(ch, method, properties, body):
+    global apply_tail
+    metrics.registry.received()
+    logger.debug("Received in routing key {}: \n\t\t{}", method.routing_key, body)
+
+    loop = asyncio.get_running_loop()
+    turn, applied = apply_tail, loop.create_future()
+    apply_tail = applied
+    loop.create_task(process_async(method, properties, body, turn, applied, acker))
+
+async def setup_async(conn, ch):
+    global connection, channel, publisher, acker
+    connection, channel = conn, ch
+
+    await middleware.declare_exchanges_async(channel)
+
+    await middleware.acall(channel.queue_declare, queue=queue_name)
+    for routing_key in routing_keys():
+        await middleware.acall(channel.queue_bind, exchange='direct_exchange', queue=queue_name, routing_key=routing_key)
+    await middleware.acall(channel.queue_bind, exchange='auction_fanout_exchange', queue=queue_name)
+
+    publisher = middleware.Publisher(channel, journal=journal)
+    acker = None
+    if args.manual_ack:
+        acker = middleware.AckBatcher(connection, channel, args.prefetch, args.ack_batch,
+                                      args.ack_interval_ms, publisher=publisher, journal=journal)
+    elif journal is not None:
+        commit_tick(connection)
 
-    if method.exchange == 'auction_fanout_exchange':
-        handle_auction_started(body)
+    channel.basic_consume(
+        queue=queue_name, on_message_callback=callback_async, auto_ack=not args.manual_ack)
 
-    elif method.routing_key == 'bid_placed':
-        handle_bid_placed(body)
+    logger.info(' [*] Waiting for messages (asyncio). To exit press CTRL+C')
 
-    elif method.routing_key == 'auction_ended':
-        handle_auction_ended(body)
+def run_async():
+    global verify_executor
+    if args.workers > 0:
+        verify_executor = (ProcessPoolExecutor if args.pool == 'process' else ThreadPoolExecutor)(max_workers=args.workers)
+    try:
+        asyncio.run(middleware.consume_forever_async(setup_async))
+    finally:
+        if verify_executor is not None:
+            verify_executor.shutdown(wait=True)
 
-def main():
+def setup(conn, ch):
+    global connection, channel, publisher, acker
+    connection, channel = conn, ch
 
-    # Declare exchanges
-    channel.exchange_declare(exchange='auction_fanout_exchange', exchange_type='fanout')
-    channel.exchange_declare(exchange='direct_exchange', exchange_type='direct')
+    middleware.declare_exchanges(channel)
 
     # Declare queue
-    channel.queue_declare(queue='ms_bid_queue')
-
-    # bind queues to listen to
-    channel.queue_bind(exchange='direct_exchange', queue='ms_bid_queue', routing_key='bid_placed')
-    channel.queue_bind(exchange='direct_exchange', queue='ms_bid_queue', routing_key='auction_ended')
-    channel.queue_bind(exchange='auction_fanout_exchange', queue='ms_bid_queue')
+    channel.queue_declare(queue=queue_name)
+
+    # bind queues to listen to; a shard only binds its own partitions
+    for routing_key in routing_keys():
+        channel.queue_bind(exchange='direct_exchange', queue=queue_name, routing_key=routing_key)
+    channel.queue_bind(exchange='auction_fanout_exchange', queue=queue_name)
+
+    publisher = middleware.Publisher(channel, journal=journal)
+    if args.manual_ack:
+        acker = middleware.AckBatcher(connection, channel, args.prefetch, args.ack_batch,
+                                      args.ack_interval_ms, publisher=publisher, journal=journal)
+    elif journal is not None:
+        commit_tick(connection)
+    if verifier is not None:
+        verifier.reconnected(redelivered=args.manual_ack)
 
     channel.basic_consume(
-        queue='ms_bid_queue', on_message_callback=callback, auto_ack=True)
+        queue=queue_name, on_message_callback=callback, auto_ack=not args.manual_ack)
 
     logger.info(' [*] Waiting for messages. To exit press CTRL+C')
-    channel.start_consuming()
+
+def main():
+    global verifier, args, duplicates, price_feed, history_dir
+
+    parser = argparse.ArgumentParser(description="MS Lance")
+    parser.add_argument("--workers", type=int, default=VERIFY_WORKERS,
+                        help="signature verification workers (0 verifies on the consumer thread)")
+    parser.add_argument("--pool", choices=["process", "thread"], default=VERIFY_POOL,
+                        help="worker pool type used when --workers > 0")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="run on pika's asyncio adapter with coroutine handlers")
+    parser.add_argument("--state-dir",
+                        help="keep a write-ahead log and snapshots of the auction state here, replayed on start "
+                             "(default: state in memory only)")
+    parser.add_argument("--snapshot-every", type=int, default=journal_log.SNAPSHOT_EVERY,
+                        help="logged events between snapshots; bounds how much log a restart replays")
+    parser.add_argument("--no-price-feed", action="store_true",
+                        help="don't publish the best price on price_<auction_id> after accepted bids")
+    parser.add_argument("--dedup-window", type=float, default=BID_WINDOW_SECONDS,
+                        help="seconds a bid id is remembered; older bids are refused as stale")
+    parser.add_argument("--dedup-size", type=int, default=DUPLICATE_FILTER_SIZE,
+                        help="most bid ids remembered at once")
+    middleware.add_partition_argument(parser)
+    parser.add_argument("--shard", type=int, default=0, help="index of this instance among --shards")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="ms_bid instances splitting the partitions (shard i owns partitions p with p %% shards == i)")
+    middleware.add_ack_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    configure_shard(args.partitions, args.shard, args.shards)
+    duplicates = DuplicateFilter(args.dedup_window, args.dedup_size)
+    price_feed = not args.no_price_feed
+    metrics.start_from_args(args, f"ms_bid.{args.shard}" if args.shards > 1 else "ms_bid")
+    if args.shards > 1:
+        logger.info("Shard {} of {}: partitions {}", args.shard, args.shards, sorted(owned_partitions))
+
+    state_dir = args.state_dir or STATE_DIR
+    if args.shards > 1:
+        state_dir = os.path.join(state_dir, f"shard-{args.shard}")
+    history_dir = os.path.join(state_dir, "history")
+    if args.state_dir:
+        recover_state(state_dir, args.snapshot_every)
+
+    if args.asyncio:
+        try:
+            run_async()
+        finally:
+            if journal is not None:
+                journal.close()
+        return
+
+    if args.workers > 0:
+        verifier = ParallelVerifier(args.workers, args.pool)
+        logger.info("Verifying signatures on a {} pool with {} workers", args.pool, args.workers)
+
+    try:
+        middleware.consume_forever(setup)
+    finally:
+        if verifier is not None:
+            verifier.shutdown()
+        if acker is not None and channel.is_open:
+            acker.flush()
+        if journal is not None:
+            journal.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
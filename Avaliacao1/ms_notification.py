@@ -7,58 +7,165 @@ de acordo com o seu ID (leilao_1, leilao_2, ...), de modo que
 somente os consumidores interessados nesses leilões recebam as
 notificações correspondentes.
 """
-import pika
-import json
 import time
+import argparse
+import asyncio
+import functools
 from datetime import datetime, timedelta
 import threading
 from loguru import logger
+import metrics
+import middleware
+import wire
 
-connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-channel = connection.channel()
+# set up by main() on the consumer thread, again after every reconnect
+connection = None
+channel = None
+publisher = None
+acker = None
+args = None
 
-def handle_bid_validated(body):
-    logger.info("Received bid validated event")
-    # body: {"auction_id": "123", "user_id": "456", "bid_amount": 100.0, "signature": "abc123"}
-    bid_data = json.loads(body)
+CONFLATE_MS = 0
+# auction_id -> [latest held (bid, body, content_type) or None, its delivery tag] while a window is open
+conflation_windows = {}
+coalesced_per_auction = {}
+
+def decode_event(event, body, content_type, key):
+    # a bad or old-format event is logged and dropped; it must not take the consumer down
+    try:
+        message = wire.decode(body, content_type)
+    except (wire.WireError, ValueError) as e:
+        error = e
+    else:
+        if isinstance(message, dict) and key in message:
+            return message
+        error = f"no {key}"
+    logger.warning("Malformed {} event: {}. Message dropped.", event, error)
+    metrics.registry.inc(f"events_dropped.{event}")
+    return None
+
+def publish_bid_validated(bid_data, body, content_type=None):
+    # clients bind their own queues to these keys, so publishing needs no declare
     auction_queue = f"auction_{bid_data['auction_id']}"
-    
-    channel.queue_declare(queue=auction_queue)
-    channel.basic_publish(
+
+    # forwarded as received; no re-encoding
+    publisher.publish(
         exchange='direct_exchange',
         routing_key=auction_queue,
-        body=json.dumps(bid_data)
+        body=body,
+        properties=middleware.properties_for(content_type or wire.JSON)
     )
-    logger.info(f" [x] Published bid validated to {auction_queue}: {bid_data}")
+    metrics.registry.inc("notifications_forwarded")
+    logger.debug(" [x] Published bid validated to {}: {}", auction_queue, bid_data)
+
+def handle_bid_validated(body, content_type=None, delivery_tag=None):
+    # returns True when the message is held back by a conflation window (acked once sent or superseded)
+    logger.debug("Received bid validated event")
+    # body: {"auction_id": "123", "user_id": "456", "bid_amount": 100.0}
+    bid_data = decode_event("bid_validated", body, content_type, 'auction_id')
+    if bid_data is None:
+        return False
+    message = (bid_data, body, content_type)
+
+    if args is None or args.conflate_ms <= 0:
+        publish_bid_validated(*message)
+        return False
+
+    auction_id = bid_data['auction_id']
+    window = conflation_windows.get(auction_id)
+    if window is None:
+        # leading edge goes out right away and opens the window
+        publish_bid_validated(*message)
+        open_window(auction_id)
+        return False
+
+    if window[0] is not None:
+        # superseded before it was sent
+        metrics.registry.inc("notifications_coalesced")
+        coalesced_per_auction[auction_id] = coalesced_per_auction.get(auction_id, 0) + 1
+        message_done(window[1])
+    window[0], window[1] = message, delivery_tag
+    return True
+
+def open_window(auction_id):
+    conflation_windows[auction_id] = [None, None]
+    middleware.call_later(connection, args.conflate_ms / 1000.0, functools.partial(close_window, auction_id))
+
+def close_window(auction_id):
+    window = conflation_windows.pop(auction_id, None)
+    if window is None or window[0] is None:
+        return
+    # trailing edge: send the latest held bid and keep throttling while the auction stays hot
+    publish_bid_validated(*window[0])
+    message_done(window[1])
+    open_window(auction_id)
 
-def handle_auction_winner(body):
-    logger.info("Received auction winner event")
+def flush_window(auction_id):
+    window = conflation_windows.pop(auction_id, None)
+    if window is not None and window[0] is not None:
+        publish_bid_validated(*window[0])
+        message_done(window[1])
+
+def drop_windows():
+    for window in conflation_windows.values():
+        if window[0] is not None:
+            metrics.registry.finished()
+    conflation_windows.clear()
+
+def handle_auction_winner(body, content_type=None):
+    logger.debug("Received auction winner event")
     # body: {"auction_id": "123", "winner_user_id": "456", "winning_bid_amount": 150.0}
-    winner_data = json.loads(body)
+    winner_data = decode_event("auction_winner", body, content_type, 'auction_id')
+    if winner_data is None:
+        return
+    # the latest held bid goes out first; the winner is never conflated
+    flush_window(winner_data['auction_id'])
     auction_queue = f"leilao_{winner_data['auction_id']}"
-    
-    channel.queue_declare(queue=auction_queue)
-    channel.basic_publish(
+
+    publisher.publish(
         exchange='direct_exchange',
         routing_key=auction_queue,
-        body=json.dumps(winner_data)
+        body=body,
+        properties=middleware.properties_for(content_type or wire.JSON)
     )
-    logger.info(f" [x] Published auction winner to {auction_queue}: {winner_data}")
+    logger.info(" [x] Published auction winner to {}: {}", auction_queue, winner_data)
+
+    coalesced = coalesced_per_auction.pop(winner_data['auction_id'], 0)
+    if args is not None and args.conflate_ms > 0:
+        logger.info("Conflation: {} bid notifications coalesced for auction {}", coalesced, winner_data['auction_id'])
 
 def callback(ch, method, properties, body):
-    logger.info(f"Received in routing key {method.routing_key}: \n\t\t{body}")
+    metrics.registry.received()
+    logger.debug("Received in routing key {}: \n\t\t{}", method.routing_key, body)
 
-    logger.debug(f"\n\nch: {ch}\nmethod: {method}\nproperties: {properties}\nbody: {body}\n\n")
+    logger.debug("\n\nch: {}\nmethod: {}\nproperties: {}\nbody: {}\n\n", ch, method, properties, body)
 
-    if method.routing_key == 'bid_validated':
-        handle_bid_validated(body)
+    deferred = False
+    try:
+        if method.routing_key == 'bid_validated':
+            with metrics.registry.timed("handle_bid_validated"):
+                deferred = handle_bid_validated(body, properties.content_type, method.delivery_tag)
 
-    elif method.routing_key == 'auction_winner':
-        handle_auction_winner(body)
+        elif method.routing_key == 'auction_winner':
+            with metrics.registry.timed("handle_auction_winner"):
+                handle_auction_winner(body, properties.content_type)
+    finally:
+        if not deferred:
+            message_done(method.delivery_tag)
 
-def main():
-    # Declare exchanges
-    channel.exchange_declare(exchange='direct_exchange', exchange_type='direct')
+def message_done(delivery_tag):
+    metrics.registry.finished()
+    if acker is not None:
+        if delivery_tag is not None:
+            acker.done(delivery_tag)
+    else:
+        publisher.flush()
+
+def setup(conn, ch):
+    global connection, channel, publisher, acker
+    connection, channel = conn, ch
+
+    middleware.declare_exchanges(channel)
 
     # Declare queue
     channel.queue_declare(queue='ms_notification_queue')
@@ -67,11 +174,99 @@ def main():
     channel.queue_bind(exchange='direct_exchange', queue='ms_notification_queue', routing_key='bid_validated')
     channel.queue_bind(exchange='direct_exchange', queue='ms_notification_queue', routing_key='auction_winner')
 
+    publisher = middleware.Publisher(channel)
+    if args.manual_ack:
+        # held bids are unacked and come back from the broker
+        drop_windows()
+        acker = middleware.AckBatcher(connection, channel, args.prefetch, args.ack_batch,
+                                      args.ack_interval_ms, publisher=publisher)
+    else:
+        for auction_id in list(conflation_windows):
+            flush_window(auction_id)
+
     channel.basic_consume(
-        queue='ms_notification_queue', on_message_callback=callback, auto_ack=True)
+        queue='ms_notification_queue', on_message_callback=callback, auto_ack=not args.manual_ack)
 
     logger.info(' [*] Waiting for messages. To exit press CTRL+C')
-    channel.start_consuming()
+
+# asyncio run mode: handlers are coroutines and publishing never waits on the broker
+async def handle_bid_validated_async(body, content_type=None, delivery_tag=None):
+    return handle_bid_validated(body, content_type, delivery_tag)
+
+async def handle_auction_winner_async(body, content_type=None):
+    handle_auction_winner(body, content_type)
+
+async def process_async(method, properties, body, owner):
+    deferred = False
+    try:
+        if method.routing_key == 'bid_validated':
+            deferred = await handle_bid_validated_async(body, properties.content_type, method.delivery_tag)
+
+        elif method.routing_key == 'auction_winner':
+            await handle_auction_winner_async(body, properties.content_type)
+    except Exception as e:
+        logger.exception("Error while handling message: {}", e)
+    finally:
+        # tags from before a reconnect mean nothing to the new channel
+        if not deferred:
+            if owner is acker:
+                message_done(method.delivery_tag)
+            else:
+                metrics.registry.finished()
+
+def callback_async(ch, method, properties, body):
+    metrics.registry.received()
+    logger.debug("Received in routing key {}: \n\t\t{}", method.routing_key, body)
+    # tasks start in creation order, so notifications keep their arrival order
+    asyncio.get_running_loop().create_task(process_async(method, properties, body, acker))
+
+async def setup_async(conn, ch):
+    global connection, channel, publisher, acker
+    connection, channel = conn, ch
+
+    await middleware.declare_exchanges_async(channel)
+
+    await middleware.acall(channel.queue_declare, queue='ms_notification_queue')
+    await middleware.acall(channel.queue_bind, exchange='direct_exchange', queue='ms_notification_queue', routing_key='bid_validated')
+    await middleware.acall(channel.queue_bind, exchange='direct_exchange', queue='ms_notification_queue', routing_key='auction_winner')
+
+    publisher = middleware.Publisher(channel)
+    acker = None
+    if args.manual_ack:
+        drop_windows()
+        acker = middleware.AckBatcher(connection, channel, args.prefetch, args.ack_batch,
+                                      args.ack_interval_ms, publisher=publisher)
+    else:
+        for auction_id in list(conflation_windows):
+            flush_window(auction_id)
+
+    channel.basic_consume(
+        queue='ms_notification_queue', on_message_callback=callback_async, auto_ack=not args.manual_ack)
+
+    logger.info(' [*] Waiting for messages (asyncio). To exit press CTRL+C')
+
+def main():
+    global args
+
+    parser = argparse.ArgumentParser(description="MS Notificação")
+    parser.add_argument("--conflate-ms", type=int, default=CONFLATE_MS,
+                        help="forward at most the latest validated bid per auction every N ms (0 forwards all)")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="run on pika's asyncio adapter with coroutine handlers")
+    middleware.add_ack_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    metrics.start_from_args(args, "ms_notification")
+
+    if args.asyncio:
+        asyncio.run(middleware.consume_forever_async(setup_async))
+        return
+
+    try:
+        middleware.consume_forever(setup)
+    finally:
+        if acker is not None and channel.is_open:
+            acker.flush()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
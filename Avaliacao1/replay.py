@@ -0,0 +1,466 @@
+"""
+Gravação e reprodução de tráfego para testes de regressão de desempenho.
+
+record escuta auction_fanout_exchange e direct_exchange num broker real e
+grava cada mensagem num trace binário compacto com o instante relativo de
+chegada. replay reinjeta os eventos de entrada do trace (leilões iniciados,
+lances, leilões encerrados) no MS Lance/MS Notificação na velocidade
+original, N vezes mais rápido ou o mais rápido possível, em processo pelo
+fakebroker ou contra um broker local com os serviços já rodando. Ao final
+confere se os vencedores em auction_winner são os mesmos da gravação e
+grava vazão e latências em JSON; compare mostra a diferença entre dois
+resultados (por exemplo, antes e depois de uma mudança).
+
+    python replay.py record storm.trace --duration 600
+    python replay.py replay storm.trace --speed 0 --json before.json
+    python replay.py replay storm.trace --speed 4 --broker --json after.json
+    python replay.py compare before.json after.json --max-slowdown 10
+
+Os lances são reenviados com as assinaturas originais, então o replay
+precisa das mesmas chaves públicas (--keys-dir, identidades do keygen).
+Lances mais antigos que a janela de duplicatas seriam recusados como
+stale: em processo a janela é desligada, contra o broker inicie o MS Lance
+com --dedup-window maior que a idade do trace. Com --state-dir o MS Lance
+também guarda no journal os bid_id que já aceitou, então cada replay
+contra o broker precisa de um MS Lance novo (sem --state-dir ou com um
+diretório vazio); senão todos os lances voltam como duplicados.
+
+Trace: cabeçalho (b'TRCE', versão, epoch do início) e registros (instante,
+exchange, content type, tamanho da routing key, tamanho do corpo, routing
+key, corpo), little-endian.
+"""
+import argparse
+import json
+import os
+import platform
+import struct
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from loguru import logger
+import bench_e2e
+import fakebroker
+import metrics
+import middleware
+import ms_bid
+import ms_notification
+import wire
+
+MAGIC = b'TRCE'
+VERSION = 1
+# codes stored per record; anything else is not recorded
+EXCHANGES = ('', 'auction_fanout_exchange', 'direct_exchange')
+CONTENT_TYPES = (None, wire.JSON, wire.BINARY)
+# events replayed into the services; every other recorded message is an output to compare against
+INPUT_EVENTS = ('bid_placed', 'auction_ended')
+# outputs stop arriving for this long -> the replay against a broker is considered drained
+DRAIN_QUIET_SECONDS = 2.0
+REPLAY_BURST = 100
+
+_header = struct.Struct('<4sHd')
+_record = struct.Struct('<dBBHI')
+
+
+class TraceWriter:
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'wb')
+        self._started = time.monotonic()
+        self._file.write(_header.pack(MAGIC, VERSION, time.time()))
+
+    def write(self, exchange, routing_key, content_type, body):
+        if exchange not in EXCHANGES:
+            return
+        if content_type not in CONTENT_TYPES:
+            logger.warning("Unknown content type {} on {}; message not recorded", content_type, routing_key)
+            return
+        key = routing_key.encode('utf-8')
+        self._file.write(_record.pack(time.monotonic() - self._started, EXCHANGES.index(exchange),
+                                      CONTENT_TYPES.index(content_type), len(key), len(body)))
+        self._file.write(key)
+        self._file.write(body)
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+
+def read_trace(path):
+    # returns (recording start epoch, [(offset_s, exchange, routing_key, content_type, body)])
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, started = _header.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a traffic trace")
+    records = []
+    offset = _header.size
+    while offset + _record.size <= len(data):
+        at, exchange, content_type, key_length, body_length = _record.unpack_from(data, offset)
+        offset += _record.size
+        end = offset + key_length + body_length
+        if end > len(data):
+            # the recorder was killed mid-write
+            logger.warning("Trace {} ends with a truncated record", path)
+            break
+        routing_key = data[offset:offset + key_length].decode('utf-8')
+        records.append((at, EXCHANGES[exchange], routing_key, CONTENT_TYPES[content_type],
+                        data[offset + key_length:end]))
+        offset = end
+    return started, records
+
+
+class Recorder:
+    def __init__(self, writer, partitions):
+        self.writer = writer
+        self.partitions = partitions
+        self.auctions = set()
+        self.channel = None
+
+    def setup(self, channel):
+        self.channel = channel
+        middleware.declare_exchanges(channel)
+        self.queue = channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+        channel.queue_bind(exchange='auction_fanout_exchange', queue=self.queue)
+        # direct exchanges have no wildcards: bind every fixed key, per-auction keys as auctions start
+        keys = ['bid_validated', 'auction_winner', 'state_query']
+        for event in INPUT_EVENTS:
+            if self.partitions > 1:
+                keys.extend(f"{event}.{p}" for p in range(self.partitions))
+            else:
+                keys.append(event)
+        for routing_key in keys:
+            channel.queue_bind(exchange='direct_exchange', queue=self.queue, routing_key=routing_key)
+        channel.basic_consume(queue=self.queue, on_message_callback=self.on_message, auto_ack=True)
+
+    def on_message(self, ch, method, properties, body):
+        self.writer.write(method.exchange, method.routing_key, properties.content_type, body)
+        if method.exchange == 'auction_fanout_exchange':
+            try:
+                auction_id = wire.decode(body, properties.content_type)['id']
+            except (wire.WireError, ValueError, KeyError, TypeError) as e:
+                # recorded as is; the services drop it on replay
+                logger.warning("Malformed auction start recorded: {}", e)
+                return
+            if auction_id not in self.auctions:
+                self.auctions.add(auction_id)
+                for prefix in ('auction_', 'leilao_', 'price_'):
+                    ch.queue_bind(exchange='direct_exchange', queue=self.queue, routing_key=f"{prefix}{auction_id}")
+
+
+def record(args):
+    writer = TraceWriter(args.trace)
+    recorder = Recorder(writer, args.partitions)
+    connection = middleware.get_connection()
+    recorder.setup(middleware.get_channel())
+    if args.duration:
+        middleware.call_later(connection, args.duration, recorder.channel.stop_consuming)
+    logger.info("Recording to {} (Ctrl+C to stop)", args.trace)
+    try:
+        recorder.channel.start_consuming()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        logger.info("{} messages recorded in {}", writer.count, args.trace)
+
+
+def prepare(records, partitions):
+    # splits a trace into the inputs to replay (re-keyed for the target partitioning) and the
+    # recorded winners / validated bids to compare against
+    inputs = []
+    winners = {}
+    validated = 0
+    for at, exchange, routing_key, content_type, body in records:
+        event = middleware.event_of(routing_key)
+        if exchange == 'auction_fanout_exchange':
+            inputs.append((at, exchange, routing_key, content_type, body, None))
+        elif exchange == 'direct_exchange' and event in INPUT_EVENTS:
+            try:
+                message = wire.decode(body, content_type)
+                auction_id = message['auction_id'] if event == 'bid_placed' else message['id']
+            except (wire.WireError, ValueError, KeyError, TypeError):
+                # replayed as recorded; the services count and drop it
+                inputs.append((at, exchange, routing_key, content_type, body, None))
+                continue
+            inputs.append((at, exchange, middleware.partitioned_key(event, auction_id, partitions), content_type,
+                           body, message.get('bid_id') if event == 'bid_placed' else None))
+        elif routing_key == 'auction_winner':
+            message = wire.decode(body, content_type)
+            winners[message['auction_id']] = [message['winner_user_id'], message['winning_bid_amount']]
+        elif routing_key == 'bid_validated':
+            validated += 1
+    if inputs:
+        # replay time starts at the first input, not at the start of the recording
+        first = inputs[0][0]
+        inputs = [(at - first,) + tuple(rest) for at, *rest in inputs]
+    return inputs, winners, validated
+
+
+class Tap:
+    # collects the services' outputs during a replay
+    def __init__(self):
+        self.sent_at = {}
+        self.latencies = []
+        self.winners = {}
+        self.validated = 0
+        self.last_message = time.perf_counter()
+
+    def setup(self, channel):
+        queue = channel.queue_declare(queue='', exclusive=True, auto_delete=True).method.queue
+        for routing_key in ('bid_validated', 'auction_winner'):
+            channel.queue_bind(exchange='direct_exchange', queue=queue, routing_key=routing_key)
+        channel.basic_consume(queue=queue, on_message_callback=self.on_message, auto_ack=True)
+
+    def on_message(self, ch, method, properties, body):
+        self.last_message = time.perf_counter()
+        message = wire.decode(body, properties.content_type)
+        if method.routing_key == 'auction_winner':
+            self.winners[message['auction_id']] = [message['winner_user_id'], message['winning_bid_amount']]
+            return
+        self.validated += 1
+        sent_at = self.sent_at.pop(message.get('bid_id'), None)
+        if sent_at is not None:
+            self.latencies.append(time.perf_counter() - sent_at)
+
+
+def pace(start, at, speed, idle):
+    # waits until the input recorded at `at` is due; idle() keeps the services running meanwhile
+    if speed <= 0:
+        return
+    due = start + at / speed
+    while True:
+        idle()
+        remaining = due - time.perf_counter()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, 0.005))
+
+def replay_in_process(inputs, tap, args):
+    broker = fakebroker.FakeBroker()
+    middleware.connection_factory = broker.connect
+    options = {"workers": args.workers, "pool": args.pool, "conflate_ms": args.conflate_ms,
+               "journal": args.journal, "manual_ack": args.manual_ack}
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        bench_e2e.reset_services(args.keys_dir, options)
+        ms_bid.history_dir = os.path.join(state_dir, "history")
+        # recorded bids keep their original timestamps, however old the trace is
+        ms_bid.duplicates = ms_bid.DuplicateFilter(window=float('inf'))
+        ms_bid.configure_shard(args.partitions, 0, 1)
+        if args.journal:
+            ms_bid.recover_state(os.path.join(state_dir, "state"))
+
+        bid_conn = broker.connect()
+        ms_bid.setup(bid_conn, bid_conn.channel())
+        if args.workers:
+            ms_bid.verifier = ms_bid.ParallelVerifier(args.workers, args.pool)
+        notification_conn = broker.connect()
+        ms_notification.setup(notification_conn, notification_conn.channel())
+        tap.setup(broker.connect().channel())
+
+        producer = broker.connect().channel()
+        in_flight = lambda: ms_bid.verifier is None or not ms_bid.verifier.pending
+        idle = lambda: broker.run_until_idle(until=in_flight)
+        start = time.perf_counter()
+        for i, (at, exchange, routing_key, content_type, body, bid_id) in enumerate(inputs):
+            pace(start, at, args.speed, idle)
+            if bid_id is not None:
+                tap.sent_at[bid_id] = time.perf_counter()
+            producer.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                   properties=middleware.properties_for(content_type))
+            if args.speed <= 0 and i % REPLAY_BURST == REPLAY_BURST - 1:
+                idle()
+        broker.run_until_idle(wait_timers=True, until=in_flight)
+        elapsed = time.perf_counter() - start
+
+        if ms_bid.verifier is not None:
+            ms_bid.verifier.shutdown()
+        if ms_bid.journal is not None:
+            ms_bid.journal.close()
+
+    queue_name = ms_bid.queue_name
+    return elapsed, {
+        "ms_bid": bench_e2e.latency_summary(broker.queues[queue_name].latencies),
+        "ms_notification": bench_e2e.latency_summary(broker.queues['ms_notification_queue'].latencies),
+    }, metrics.registry.snapshot()["counters"]
+
+def replay_on_broker(inputs, tap, expected_winners, args):
+    ready = threading.Event()
+
+    def listen():
+        channel = middleware.get_channel()
+        middleware.declare_exchanges(channel)
+        tap.setup(channel)
+        ready.set()
+        channel.start_consuming()
+
+    threading.Thread(target=listen, name="replay-tap", daemon=True).start()
+    if not ready.wait(10):
+        raise RuntimeError("could not start the output listener")
+
+    publisher = middleware.Publisher()
+    start = time.perf_counter()
+    for at, exchange, routing_key, content_type, body, bid_id in inputs:
+        pace(start, at, args.speed, publisher.flush)
+        if bid_id is not None:
+            tap.sent_at[bid_id] = time.perf_counter()
+        publisher.publish(exchange=exchange, routing_key=routing_key, body=body,
+                          properties=middleware.properties_for(content_type))
+    publisher.flush()
+
+    # rejected bids produce nothing, so wait for every recorded winner, then for the outputs to stop
+    deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < deadline:
+        if (set(expected_winners) <= set(tap.winners)
+                and time.perf_counter() - tap.last_message > DRAIN_QUIET_SECONDS):
+            break
+        time.sleep(0.05)
+    publisher.close()
+    return max(tap.last_message, start) - start, {}, {}
+
+def replay(args):
+    started, records = read_trace(args.trace)
+    inputs, expected_winners, recorded_validated = prepare(records, args.partitions)
+    bids = sum(1 for record in inputs if record[5] is not None)
+    logger.info("Replaying {} inputs ({} bids) recorded {} at {}", len(inputs), bids,
+                datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+                f"{args.speed}x" if args.speed > 0 else "maximum speed")
+
+    tap = Tap()
+    if args.broker:
+        elapsed, stages, counters = replay_on_broker(inputs, tap, expected_winners, args)
+        if tap.validated < recorded_validated:
+            # the usual cause: ms_bid kept the bid ids of an earlier replay in its journal
+            logger.warning("Only {} of {} recorded bids were validated. If ms_bid already saw this trace, "
+                           "restart it without --state-dir or with an empty one", tap.validated, recorded_validated)
+    else:
+        elapsed, stages, counters = replay_in_process(inputs, tap, args)
+
+    # only auctions whose end was recorded can be checked
+    mismatches = [{"auction_id": auction_id, "recorded": winner, "replayed": tap.winners.get(auction_id)}
+                  for auction_id, winner in sorted(expected_winners.items()) if tap.winners.get(auction_id) != winner]
+    stages["end_to_end"] = bench_e2e.latency_summary(tap.latencies)
+    result = {
+        "commit": bench_e2e.git_commit(),
+        "python": platform.python_version(),
+        "timestamp": datetime.now().isoformat(),
+        "trace": os.path.abspath(args.trace),
+        "mode": "broker" if args.broker else "in-process",
+        "speed": args.speed,
+        "inputs": len(inputs),
+        "bids": bids,
+        "elapsed_s": round(elapsed, 3),
+        "bids_per_sec": round(bids / elapsed, 1) if elapsed > 0 else None,
+        "validated": tap.validated,
+        "recorded_validated": recorded_validated,
+        "winners": tap.winners,
+        "winners_checked": len(expected_winners),
+        "winner_mismatches": mismatches,
+        "stages": stages,
+        "counters": counters,
+    }
+
+    stage_text = "  ".join(f"{name} p50={s['p50_ms']} p99={s['p99_ms']}" for name, s in stages.items())
+    print(f"{result['bids_per_sec']} bids/s  validated={tap.validated} (recorded {recorded_validated})  "
+          f"winners={len(expected_winners) - len(mismatches)}/{len(expected_winners)} match  {stage_text}")
+    for mismatch in mismatches:
+        print(f"winner mismatch in {mismatch['auction_id']}: recorded {mismatch['recorded']}, replayed {mismatch['replayed']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"results written to {args.json}")
+    return 1 if mismatches else 0
+
+
+def change(before, after):
+    if before is None or after is None:
+        return "n/a"
+    if not before:
+        return f"{before} -> {after}"
+    return f"{before} -> {after} ({(after - before) / before * 100:+.1f}%)"
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline["trace"] != candidate["trace"]:
+        logger.warning("Results come from different traces: {} vs {}", baseline["trace"], candidate["trace"])
+    if (baseline["mode"], baseline["speed"]) != (candidate["mode"], candidate["speed"]):
+        # paced replays measure the trace's rate as much as the build
+        logger.warning("Results were replayed differently; throughput and latency are not comparable")
+
+    for name, result in (("baseline", baseline), ("candidate", candidate)):
+        speed = f"{result['speed']}x" if result["speed"] > 0 else "max speed"
+        print(f"{name:<10}{result['commit']} ({result['mode']}, {speed})")
+    print(f"bids/s            {change(baseline['bids_per_sec'], candidate['bids_per_sec'])}")
+    print(f"validated         {change(baseline['validated'], candidate['validated'])}")
+    for name in baseline["stages"]:
+        if name in candidate["stages"]:
+            for p in ("p50_ms", "p99_ms"):
+                print(f"{name + ' ' + p:<26}{change(baseline['stages'][name][p], candidate['stages'][name][p])}")
+
+    failed = False
+    differing = sorted(a for a in set(baseline["winners"]) | set(candidate["winners"])
+                       if baseline["winners"].get(a) != candidate["winners"].get(a))
+    for auction_id in differing:
+        print(f"winner differs in {auction_id}: {baseline['winners'].get(auction_id)} vs {candidate['winners'].get(auction_id)}")
+    if differing or candidate["winner_mismatches"]:
+        failed = True
+    if args.max_slowdown is not None and baseline["bids_per_sec"] and candidate["bids_per_sec"]:
+        slowdown = (baseline["bids_per_sec"] - candidate["bids_per_sec"]) / baseline["bids_per_sec"] * 100
+        if slowdown > args.max_slowdown:
+            print(f"throughput dropped {slowdown:.1f}% (allowed {args.max_slowdown}%)")
+            failed = True
+    print("FAIL" if failed else "OK")
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record traffic and replay it against the services")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="tap both exchanges into a trace file")
+    record_parser.add_argument("trace")
+    record_parser.add_argument("--duration", type=float, default=0, help="stop after N seconds (0: until Ctrl+C)")
+    middleware.add_partition_argument(record_parser)
+
+    replay_parser = commands.add_parser("replay", help="feed a trace's inputs to ms_bid/ms_notification")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("--speed", type=float, default=1.0,
+                               help="1 keeps the recorded timing, N is N times faster, 0 is as fast as possible")
+    replay_parser.add_argument("--broker", action="store_true",
+                               help="publish to the local RabbitMQ, where the services are already running")
+    replay_parser.add_argument("--keys-dir", default=ms_bid.KEYS_DIR, help="public keys of the recorded bidders")
+    replay_parser.add_argument("--drain-timeout", type=float, default=60.0)
+    replay_parser.add_argument("--workers", type=int, default=0)
+    replay_parser.add_argument("--pool", choices=["process", "thread"], default=ms_bid.VERIFY_POOL)
+    replay_parser.add_argument("--conflate-ms", type=int, default=0)
+    replay_parser.add_argument("--journal", action="store_true", help="write ms_bid's state log to a temporary directory")
+    replay_parser.add_argument("--manual-ack", action="store_true")
+    replay_parser.add_argument("--json", help="write machine-readable results to this file")
+    middleware.add_partition_argument(replay_parser)
+
+    compare_parser = commands.add_parser("compare", help="throughput/latency change between two replay results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--max-slowdown", type=float,
+                                help="fail if bids/s dropped by more than this percentage")
+    args = parser.parse_args()
+
+    if args.command == "replay" and not args.broker:
+        # the services' warnings (unknown or duplicate auctions) would bury the report; only errors are shown
+        logger.remove()
+        logger.add(sys.stderr, filter=lambda r: r["level"].no >= 40 or r["name"] == __name__)
+    if args.command == "record":
+        record(args)
+    elif args.command == "replay":
+        sys.exit(replay(args))
+    else:
+        sys.exit(compare(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Assinatura digital dos lances: bytes canônicos da mensagem e
+verificação com a chave pública do cliente. Usado pelo cliente (assina)
+e pelo MS Lance (verifica), inclusive dentro de um pool de processos.
+"""
+import json
+import base64
+from functools import lru_cache
+from Crypto.PublicKey import RSA
+from Crypto.Signature import pkcs1_15
+from Crypto.Hash import SHA256
+
+
+def canonical_bytes(message: dict) -> bytes:
+    return json.dumps(message, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+def sign_bytes(private_key, message_bytes: bytes) -> bytes:
+    return pkcs1_15.new(private_key).sign(SHA256.new(message_bytes))
+
+def sign(private_key, message_bytes: bytes) -> str:
+    return base64.b64encode(sign_bytes(private_key, message_bytes)).decode('utf-8')
+
+def verify(public_key, message_bytes: bytes, signature: bytes) -> bool:
+    try:
+        pkcs1_15.new(public_key).verify(SHA256.new(message_bytes), signature)
+        return True
+    except (ValueError, TypeError):
+        return False
+
+@lru_cache(maxsize=1024)
+def _key_from_numbers(n: int, e: int):
+    return RSA.construct((n, e))
+
+def verify_with_numbers(n: int, e: int, message_bytes: bytes, signature: bytes) -> bool:
+    # picklable entry point for process pools: RsaKey objects can't cross process boundaries
+    return verify(_key_from_numbers(n, e), message_bytes, signature)
+
+@lru_cache(maxsize=1024)
+def _private_key_from_numbers(n: int, e: int, d: int):
+    return RSA.construct((n, e, d))
+
+def sign_with_numbers(n: int, e: int, d: int, message_bytes: bytes) -> bytes:
+    return sign_bytes(_private_key_from_numbers(n, e, d), message_bytes)
@@ -0,0 +1,117 @@
+import os
+import pytest
+import journal
+import ms_bid
+import wire
+
+
+def test_recover_returns_appended_records(tmp_path):
+    log = journal.Journal(str(tmp_path))
+    assert log.recover() == (None, [])
+    for i in range(3):
+        log.append({"op": "bid", "n": i})
+    log.commit()
+    log.close()
+    log = journal.Journal(str(tmp_path))
+    assert log.recover() == (None, [{"op": "bid", "n": i} for i in range(3)])
+
+def test_torn_tail_is_truncated(tmp_path):
+    log = journal.Journal(str(tmp_path))
+    log.recover()
+    log.append({"op": "start", "id": "leilao1"})
+    log.append({"op": "bid", "n": 1})
+    log.close()
+    path = os.path.join(str(tmp_path), "wal-000000.log")
+    intact = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        # a crash mid-append: header of a longer record, half its payload
+        f.write(journal._header.pack(100, 0) + b'{"op":')
+    log = journal.Journal(str(tmp_path))
+    assert log.recover() == (None, [{"op": "start", "id": "leilao1"}, {"op": "bid", "n": 1}])
+    assert os.path.getsize(path) == intact
+    # appends after recovery land after the last good record
+    log.append({"op": "end", "id": "leilao1"})
+    log.close()
+    assert journal.Journal(str(tmp_path)).recover()[1][-1] == {"op": "end", "id": "leilao1"}
+
+def test_snapshot_rolls_segments_and_removes_old_files(tmp_path):
+    state = {"count": 0}
+    log = journal.Journal(str(tmp_path), snapshot_every=3, state_fn=lambda: dict(state))
+    log.recover()
+    for i in range(5):
+        log.append({"n": i})
+        state["count"] += 1
+        log.commit()
+    log.close()
+    # the snapshot after the third record starts segment 1; segment 0 is gone
+    assert sorted(os.listdir(str(tmp_path))) == ["snapshot-000001.json", "wal-000001.log"]
+    log = journal.Journal(str(tmp_path), snapshot_every=3)
+    assert log.recover() == ({"count": 3}, [{"n": 3}, {"n": 4}])
+
+def test_unreadable_snapshot_is_skipped(tmp_path):
+    log = journal.Journal(str(tmp_path), snapshot_every=1, state_fn=lambda: {"ok": True})
+    log.recover()
+    log.append({"n": 0})
+    log.commit()
+    log.close()
+    with open(os.path.join(str(tmp_path), "snapshot-000001.json"), 'w') as f:
+        f.write('{"ok"')
+    assert journal.Journal(str(tmp_path)).recover() == (None, [])
+
+
+class NullPublisher:
+    def publish(self, **kwargs):
+        pass
+
+
+@pytest.fixture
+def fresh_ms_bid(monkeypatch, tmp_path):
+    monkeypatch.setattr(ms_bid, "publisher", NullPublisher())
+    monkeypatch.setattr(ms_bid, "history_dir", str(tmp_path / "history"))
+    monkeypatch.setattr(ms_bid, "journal", None)
+
+    def reset():
+        monkeypatch.setattr(ms_bid, "auctions", ms_bid.AuctionRegistry())
+        monkeypatch.setattr(ms_bid, "duplicates", ms_bid.DuplicateFilter(window=float('inf')))
+    reset()
+    return reset
+
+def dump_state():
+    state = ms_bid.snapshot_state()
+    for entry in state["auctions"]:
+        entry["bids"] = ms_bid.auctions.get(entry["id"]).bids.columns()
+    return state
+
+def start(auction_id):
+    event = {"id": auction_id, "description": "chocovo", "start_time": "2025-09-01T10:00:00",
+             "end_time": "2025-09-01T10:01:30", "status": "active"}
+    ms_bid.handle_auction_started(wire.encode(wire.AUCTION_STARTED, event, wire.JSON), wire.JSON)
+
+def bid(auction_id, user_id, amount, n):
+    ms_bid.apply_bid({"auction_id": auction_id, "user_id": user_id, "bid_amount": amount,
+                      "bid_id": f"{auction_id}-{n}", "timestamp": 1000.0 + n}, True, wire.JSON)
+
+@pytest.mark.parametrize("snapshot_every", [3, 1000])
+def test_ms_bid_state_recovers_from_snapshot_and_log(fresh_ms_bid, tmp_path, snapshot_every):
+    state_dir = str(tmp_path / "state")
+    ms_bid.recover_state(state_dir, snapshot_every)
+    start("leilao1")
+    start("leilao2")
+    for n, (user_id, amount) in enumerate([("ana", 10.0), ("bia", 12.0), ("ana", 15.0)]):
+        bid("leilao1", user_id, amount, n)
+        ms_bid.journal.commit()
+    bid("leilao2", "bia", 7.0, 0)
+    end = {"id": "leilao1", "description": "chocovo", "end_time": "2025-09-01T10:01:30", "status": "ended"}
+    ms_bid.handle_auction_ended(wire.encode(wire.AUCTION_ENDED, end, wire.JSON), wire.JSON)
+    bid("leilao2", "caio", 9.0, 1)
+    ms_bid.journal.commit()
+    expected = dump_state()
+    ms_bid.journal.close()
+    assert any(name.startswith("snapshot-") for name in os.listdir(state_dir)) == (snapshot_every == 3)
+
+    fresh_ms_bid()
+    ms_bid.recover_state(state_dir, snapshot_every)
+    assert dump_state() == expected
+    assert ms_bid.auctions.get("leilao1").status == 'ended'
+    assert ms_bid.duplicates.check("leilao2-1", 1001.0, now=1001.0) == "duplicate"
+    ms_bid.journal.close()
@@ -0,0 +1,195 @@
+import json
+import queue
+import struct
+import threading
+import types
+import pytest
+import metrics
+import middleware
+import ms_bid
+import wire
+
+
+def test_duplicate_filter_refuses_seen_ids():
+    duplicates = ms_bid.DuplicateFilter(window=300, max_size=10)
+    assert duplicates.check("a", 100.0, now=110.0) is None
+    assert duplicates.add("a", 100.0, now=110.0)
+    assert duplicates.check("a", 100.0, now=110.0) == "duplicate"
+    assert not duplicates.add("a", 100.0, now=110.0)
+
+def test_duplicate_filter_refuses_evicted_ids():
+    duplicates = ms_bid.DuplicateFilter(window=300, max_size=2)
+    for i, bid_id in enumerate("abc"):
+        assert duplicates.add(bid_id, 100.0 + i, now=110.0)
+    # 'a' was evicted to make room for 'c'; its replay must not get back in
+    assert len(duplicates) == 2
+    assert duplicates.floor == 100.0
+    assert duplicates.check("a", 100.0, now=110.0) == "stale"
+    assert duplicates.check("b", 101.0, now=110.0) == "duplicate"
+    assert duplicates.check("d", 103.0, now=110.0) is None
+
+def test_duplicate_filter_window_and_skew():
+    duplicates = ms_bid.DuplicateFilter(window=300, max_size=10, skew=30)
+    assert duplicates.check("old", 100.0, now=401.0) == "stale"
+    assert duplicates.check("ahead", 431.0, now=400.0) == "stale"
+    assert duplicates.check("ok", 400.0, now=400.0) is None
+    # ids older than the window are dropped without raising the floor
+    duplicates.add("x", 100.0, now=110.0)
+    duplicates.add("y", 500.0, now=500.0)
+    assert len(duplicates) == 1
+    assert duplicates.floor == 0.0
+
+def test_duplicate_filter_evicts_by_timestamp():
+    duplicates = ms_bid.DuplicateFilter(window=300, max_size=3, skew=30)
+    # a client with a clock 25s fast must not drag the floor ahead of honest bids
+    assert duplicates.add("fast", 125.0, now=100.0)
+    for i, bid_id in enumerate("abc"):
+        assert duplicates.add(bid_id, 100.0 + i, now=100.0)
+    assert duplicates.floor == 100.0
+    assert duplicates.check("fast", 125.0, now=101.0) == "duplicate"
+    assert duplicates.check("fresh", 101.5, now=101.5) is None
+
+@pytest.mark.parametrize("body", [
+    b'{"auction_id": "leilao1", "bid_amount": 1.0, "bid_id": "b", "timestamp": 1.0, "signature": "AA=="}',
+    b'[1]',
+    b'"x"',
+    b'{"auction_id": "leilao1", "user_id": "ana", "bid_amount": "1", "bid_id": "b", "timestamp": 1.0, "signature": "AA=="}',
+    b'{"auction_id": ["leilao1"], "user_id": "ana", "bid_amount": 1.0, "bid_id": "b", "timestamp": 1.0, "signature": "AA=="}',
+    b'{"auction_id": "leilao1", "user_id": "ana", "bid_amount": 1.0, "bid_id": "b", "timestamp": 1.0, "signature": 5}',
+    b'\xff',
+])
+def test_malformed_bids_are_rejected(monkeypatch, body):
+    monkeypatch.setattr(metrics, "registry", metrics.Metrics())
+    assert ms_bid.parse_bid(body, wire.JSON) is None
+    assert metrics.registry.counters == {"bids_rejected.malformed": 1}
+
+def test_out_of_range_start_event_is_dropped(monkeypatch):
+    monkeypatch.setattr(metrics, "registry", metrics.Metrics())
+    body = bytearray(wire.encode(wire.AUCTION_STARTED, {"id": "leilao1", "description": "chocovo",
+                                                        "start_time": "2025-09-01T10:00:00",
+                                                        "end_time": "2025-09-01T10:01:30", "status": "active"}, wire.BINARY))
+    # start_time follows the id and description strings
+    offset = 2 + 2 + len("leilao1") + 2 + len("chocovo")
+    body[offset:offset + 8] = struct.pack('>d', 1e300)
+    ms_bid.handle_auction_started(bytes(body), wire.BINARY)
+    assert metrics.registry.counters == {"events_dropped.auction_started": 1}
+
+def test_restarted_auction_replaces_recovered_state(monkeypatch):
+    monkeypatch.setattr(ms_bid, "auctions", ms_bid.AuctionRegistry())
+    event = {"id": "leilao1", "description": "chocovo", "start_time": "2025-09-01T10:00:00",
+             "end_time": "2025-09-01T10:01:30", "status": "active"}
+    ms_bid.handle_auction_started(wire.encode(wire.AUCTION_STARTED, event, wire.JSON), wire.JSON)
+    ms_bid.replay_event({"op": "bid", "auction_id": "leilao1", "user_id": "ana", "bid_amount": 50.0,
+                         "bid_id": None, "timestamp": 1.0})
+    # a redelivered start leaves the auction alone, a new run's start replaces it
+    ms_bid.handle_auction_started(wire.encode(wire.AUCTION_STARTED, event, wire.JSON), wire.JSON)
+    assert ms_bid.auctions.get("leilao1").highest_bidder == "ana"
+    event["start_time"] = "2025-09-02T10:00:00"
+    ms_bid.handle_auction_started(wire.encode(wire.AUCTION_STARTED, event, wire.JSON), wire.JSON)
+    auction = ms_bid.auctions.get("leilao1")
+    assert (auction.start_time, auction.highest_bid, auction.highest_bidder) == ("2025-09-02T10:00:00", 0.0, None)
+
+
+class FakeConnection:
+    # stands in for the consumer thread: cross-thread callbacks queue up until the test runs them
+    def __init__(self):
+        self.callbacks = queue.Queue()
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+    def call_later(self, delay, callback):
+        pass
+
+
+class FakeChannel:
+    is_open = True
+
+    def __init__(self):
+        self.acks = []
+
+    def basic_qos(self, prefetch_count):
+        pass
+
+    def tx_select(self):
+        pass
+
+    def tx_commit(self):
+        pass
+
+    def basic_ack(self, delivery_tag, multiple):
+        self.acks.append(delivery_tag)
+
+
+class NullPublisher:
+    def publish(self, **kwargs):
+        pass
+
+    def flush(self):
+        pass
+
+
+def test_parallel_verifier_applies_in_arrival_order(monkeypatch):
+    connection = FakeConnection()
+    channel = FakeChannel()
+    verifier = ms_bid.ParallelVerifier(8, 'thread')
+    gates = {}
+
+    def verify(public_key, message, signature):
+        gate = gates[json.loads(message)['bid_id']] = threading.Event()
+        return verifier.executor.submit(lambda: gate.wait(5))
+    monkeypatch.setattr(verifier, "verify", verify)
+    monkeypatch.setattr(metrics, "registry", metrics.Metrics())
+    monkeypatch.setattr(ms_bid, "connection", connection)
+    monkeypatch.setattr(ms_bid, "verifier", verifier)
+    monkeypatch.setattr(ms_bid, "acker", middleware.AckBatcher(connection, channel, prefetch=100, batch_size=100))
+    monkeypatch.setattr(ms_bid, "publisher", NullPublisher())
+    monkeypatch.setattr(ms_bid, "journal", None)
+    monkeypatch.setattr(ms_bid, "auctions", ms_bid.AuctionRegistry())
+    monkeypatch.setattr(ms_bid, "duplicates", ms_bid.DuplicateFilter(window=float('inf')))
+    monkeypatch.setattr(ms_bid, "key_cache", types.SimpleNamespace(get=lambda user_id: None))
+    properties = types.SimpleNamespace(content_type=wire.JSON, reply_to=None)
+    tag = 0
+
+    def deliver(exchange, routing_key, message):
+        nonlocal tag
+        tag += 1
+        method = types.SimpleNamespace(exchange=exchange, routing_key=routing_key, delivery_tag=tag)
+        ms_bid.dispatch_parallel(method, properties, json.dumps(message).encode('utf-8'))
+
+    for auction_id in ("leilao1", "leilao2"):
+        deliver('auction_fanout_exchange', '', {"id": auction_id, "description": "chocovo",
+                                                "start_time": "2025-09-01T10:00:00",
+                                                "end_time": "2025-09-01T10:01:30", "status": "active"})
+    # serially: ana, bia and dan are accepted on leilao1 (caio only ties bia), eva wins leilao2
+    bids = [("leilao1", "ana", 10.0), ("leilao1", "bia", 20.0), ("leilao2", "eva", 5.0),
+            ("leilao1", "caio", 20.0), ("leilao1", "dan", 30.0)]
+    for n, (auction_id, user_id, amount) in enumerate(bids):
+        deliver('direct_exchange', 'bid_placed', {"auction_id": auction_id, "user_id": user_id, "bid_amount": amount,
+                                                  "bid_id": f"b{n}", "timestamp": 1000.0 + n, "signature": "AA=="})
+
+    def run_callbacks(count):
+        for _ in range(count):
+            connection.callbacks.get(timeout=5)()
+
+    try:
+        # every bid but the first verifies, latest first: nothing of leilao1 may apply yet
+        for n in reversed(range(1, len(bids))):
+            gates[f"b{n}"].set()
+            run_callbacks(1)
+        assert ms_bid.auctions.get("leilao1").highest_bidder is None
+        assert ms_bid.auctions.get("leilao2").highest_bidder == "eva"
+        assert ms_bid.acker.watermark == 2
+        gates["b0"].set()
+        run_callbacks(1)
+    finally:
+        for gate in gates.values():
+            gate.set()
+        verifier.shutdown()
+
+    auction = ms_bid.auctions.get("leilao1")
+    assert auction.bids.columns()["users"] == ["ana", "bia", "dan"]
+    assert (auction.highest_bidder, auction.highest_bid) == ("dan", 30.0)
+    assert ms_bid.acker.watermark == tag
+    ms_bid.acker.flush()
+    assert channel.acks == [tag]
@@ -0,0 +1,95 @@
+import json
+import struct
+import pytest
+from Crypto.PublicKey import RSA
+import signatures
+import wire
+
+EVENTS = [
+    (wire.BID_VALIDATED, {"auction_id": "leilao1", "user_id": "ana", "bid_amount": 12.5, "bid_id": "b1"}),
+    (wire.AUCTION_STARTED, {"id": "leilao1", "description": "chocovo", "start_time": "2025-09-01T10:00:00",
+                            "end_time": "2025-09-01T10:01:30", "status": "active"}),
+    (wire.AUCTION_ENDED, {"id": "leilao1", "description": "chocovo", "end_time": "2025-09-01T10:01:30",
+                          "status": "ended"}),
+    (wire.AUCTION_WINNER, {"auction_id": "leilao1", "winner_user_id": None, "winning_bid_amount": 0.0}),
+    (wire.PRICE, {"auction_id": "leilao1", "highest_bid": 99.0}),
+]
+
+
+@pytest.fixture(scope="module")
+def private_key():
+    return RSA.generate(1024)
+
+def signed_bid(private_key, bid, content_type):
+    payload = wire.bid_payload(bid, content_type)
+    return wire.encode_signed_bid(bid, payload, signatures.sign_bytes(private_key, payload), content_type)
+
+@pytest.mark.parametrize("content_type", [wire.JSON, wire.BINARY])
+@pytest.mark.parametrize("kind, message", EVENTS)
+def test_round_trip(kind, message, content_type):
+    assert wire.decode(wire.encode(kind, message, content_type), content_type) == message
+
+@pytest.mark.parametrize("content_type", [wire.JSON, wire.BINARY])
+def test_state_round_trip(content_type):
+    auctions = [{"id": "leilao1", "description": "chocovo", "end_time": "2025-09-01T10:01:30",
+                 "highest_bid": 10.0, "highest_bidder": "ana"},
+                {"id": "leilao2", "description": None, "end_time": "2025-09-01T10:02:00",
+                 "highest_bid": 0.0, "highest_bidder": None}]
+    assert wire.decode_state(wire.encode_state(auctions, content_type), content_type) == auctions
+
+@pytest.mark.parametrize("content_type", [wire.JSON, wire.BINARY])
+def test_signed_bid_verifies(private_key, content_type):
+    bid = wire.new_bid("leilao1", "ana", 10.0)
+    decoded, message, signature = wire.decode_signed_bid(signed_bid(private_key, bid, content_type), content_type)
+    assert decoded == bid
+    assert signatures.verify(private_key.publickey(), message, signature)
+
+@pytest.mark.parametrize("content_type", [wire.JSON, wire.BINARY])
+def test_tampered_bid_fails_verification(private_key, content_type):
+    bid = wire.new_bid("leilao1", "ana", 10.0)
+    payload = wire.bid_payload(bid, content_type)
+    signature = signatures.sign_bytes(private_key, payload)
+    body = wire.encode_signed_bid(dict(bid, bid_amount=1000.0), wire.bid_payload(dict(bid, bid_amount=1000.0), content_type),
+                                  signature, content_type)
+    _, message, signature = wire.decode_signed_bid(body, content_type)
+    assert not signatures.verify(private_key.publickey(), message, signature)
+
+def test_other_binary_versions_are_rejected():
+    body = wire.encode(wire.PRICE, {"auction_id": "leilao1", "highest_bid": 1.0}, wire.BINARY)
+    with pytest.raises(wire.WireError):
+        wire.decode(body, 'application/x-auction-v1')
+    with pytest.raises(wire.WireError):
+        wire.decode_signed_bid(body, 'application/x-auction-v1')
+    # a v1 body sent under the v2 content type
+    with pytest.raises(wire.WireError):
+        wire.decode(struct.pack('>BB', 1, wire.PRICE) + body[2:], wire.BINARY)
+
+@pytest.mark.parametrize("bid", [
+    {"auction_id": "leilao1", "bid_amount": 1.0, "bid_id": "b", "timestamp": 1.0, "signature": "AA=="},
+    [1],
+    "x",
+    {"auction_id": "leilao1", "user_id": "ana", "bid_amount": "1", "bid_id": "b", "timestamp": 1.0, "signature": "AA=="},
+    {"auction_id": ["leilao1"], "user_id": "ana", "bid_amount": 1.0, "bid_id": "b", "timestamp": 1.0, "signature": "AA=="},
+    {"auction_id": "leilao1", "user_id": "ana", "bid_amount": 1.0, "bid_id": "b", "timestamp": 1.0, "signature": 5},
+    {"auction_id": "leilao1", "user_id": "ana", "bid_amount": float('nan'), "bid_id": "b", "timestamp": 1.0, "signature": "AA=="},
+    {"auction_id": "leilao1", "user_id": "ana", "bid_amount": 1.0, "bid_id": "", "timestamp": 1.0, "signature": "AA=="},
+])
+def test_malformed_json_bids_raise_wire_error(bid):
+    with pytest.raises(wire.WireError):
+        wire.decode_signed_bid(json.dumps(bid).encode('utf-8'), wire.JSON)
+
+def test_malformed_binary_bid_raises_wire_error():
+    bid = {"auction_id": None, "user_id": "ana", "bid_amount": 1.0, "bid_id": "b", "timestamp": 1.0}
+    with pytest.raises(wire.WireError):
+        wire.decode_signed_bid(wire.encode_signed_bid(bid, wire.bid_payload(bid), b'sig'), wire.BINARY)
+    with pytest.raises(wire.WireError):
+        wire.decode_signed_bid(wire.bid_payload(bid)[:-3], wire.BINARY)
+
+@pytest.mark.parametrize("kind", [wire.AUCTION_STARTED, wire.AUCTION_ENDED])
+def test_out_of_range_time_raises_wire_error(kind):
+    body = bytearray(wire.encode(kind, dict(EVENTS)[kind], wire.BINARY))
+    # end_time is the second-to-last field in both events
+    offset = len(body) - struct.calcsize('>H') - len("active" if kind == wire.AUCTION_STARTED else "ended") - 8
+    body[offset:offset + 8] = struct.pack('>d', 1e300)
+    with pytest.raises(wire.WireError):
+        wire.decode(bytes(body), wire.BINARY)
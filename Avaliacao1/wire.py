@@ -0,0 +1,213 @@
+"""
+Formato das mensagens trocadas entre os serviços.
+
+JSON continua aceito (e é o que se assume quando a mensagem não traz
+content_type). O formato binário é versionado: cada mensagem começa com
+(versão, tipo) e os campos seguem em ordem fixa. Em um lance, a assinatura
+vai no fim e cobre exatamente os bytes que a precedem, então o MS Lance
+verifica sem re-serializar nada.
+
+Versão 2: o lance leva bid_id (nonce único gerado pelo cliente) e
+timestamp (epoch do cliente), ambos cobertos pela assinatura, para o
+MS Lance descartar reenvios e replays. O content type binário traz a
+versão (application/x-auction-v2), então uma mensagem v1 é reconhecida
+pelo cabeçalho AMQP e não só ao falhar na decodificação.
+"""
+import json
+import math
+import base64
+import struct
+import time
+import uuid
+from datetime import datetime
+import signatures
+
+VERSION = 2
+
+JSON = 'application/json'
+# only this version is decoded, and the content type says so
+BINARY = f'application/x-auction-v{VERSION}'
+CONTENT_TYPES = {'json': JSON, 'binary': BINARY}
+DEFAULT_FORMAT = BINARY
+
+BID = 1
+BID_VALIDATED = 2
+AUCTION_STARTED = 3
+AUCTION_ENDED = 4
+AUCTION_WINNER = 5
+PRICE = 6
+STATE = 7
+
+# field kinds: 's' utf-8 string (may be None), 'f' float64, 't' ISO time sent as epoch float64
+SCHEMAS = {
+    BID: (('auction_id', 's'), ('user_id', 's'), ('bid_amount', 'f'), ('bid_id', 's'), ('timestamp', 'f')),
+    BID_VALIDATED: (('auction_id', 's'), ('user_id', 's'), ('bid_amount', 'f'), ('bid_id', 's')),
+    AUCTION_STARTED: (('id', 's'), ('description', 's'), ('start_time', 't'), ('end_time', 't'), ('status', 's')),
+    AUCTION_ENDED: (('id', 's'), ('description', 's'), ('end_time', 't'), ('status', 's')),
+    AUCTION_WINNER: (('auction_id', 's'), ('winner_user_id', 's'), ('winning_bid_amount', 'f')),
+    # current best price of an auction, published on price_<auction_id> after every accepted bid
+    PRICE: (('auction_id', 's'), ('highest_bid', 'f')),
+    # reply to a state query: a u32 count follows, then one AUCTION_STATE row per active auction
+    STATE: (),
+}
+AUCTION_STATE = (('id', 's'), ('description', 's'), ('end_time', 't'), ('highest_bid', 'f'), ('highest_bidder', 's'))
+
+_header = struct.Struct('>BB')
+_u16 = struct.Struct('>H')
+_f64 = struct.Struct('>d')
+_u32 = struct.Struct('>I')
+_NONE = 0xFFFF
+
+
+class WireError(ValueError):
+    pass
+
+
+def _pack(kind, message) -> bytes:
+    parts = [_header.pack(VERSION, kind)]
+    _pack_fields(SCHEMAS[kind], message, parts)
+    return b''.join(parts)
+
+def _pack_fields(schema, message, parts):
+    for name, field in schema:
+        value = message[name]
+        if field == 's':
+            if value is None:
+                parts.append(_u16.pack(_NONE))
+            else:
+                data = str(value).encode('utf-8')
+                parts.append(_u16.pack(len(data)))
+                parts.append(data)
+        elif field == 't':
+            parts.append(_f64.pack(datetime.fromisoformat(value).timestamp()))
+        else:
+            parts.append(_f64.pack(value))
+
+def _unpack(body: bytes, offset=0):
+    # returns (kind, message, offset just past the last field)
+    try:
+        version, kind = _header.unpack_from(body, offset)
+        if version != VERSION or kind not in SCHEMAS:
+            raise WireError(f"Unsupported message version {version} / type {kind}")
+        message, offset = _unpack_fields(SCHEMAS[kind], body, offset + _header.size)
+        return kind, message, offset
+    except WireError:
+        raise
+    except (struct.error, UnicodeDecodeError, TypeError, ValueError, OverflowError, OSError) as e:
+        # OverflowError/OSError/ValueError: a time field out of datetime's range (or NaN)
+        raise WireError(f"Malformed message: {e}") from e
+
+def _unpack_fields(schema, body, offset):
+    message = {}
+    for name, field in schema:
+        if field == 's':
+            (length,) = _u16.unpack_from(body, offset)
+            offset += _u16.size
+            if length == _NONE:
+                message[name] = None
+            else:
+                message[name] = bytes(body[offset:offset + length]).decode('utf-8')
+                offset += length
+        else:
+            (value,) = _f64.unpack_from(body, offset)
+            offset += _f64.size
+            message[name] = datetime.fromtimestamp(value).isoformat() if field == 't' else value
+    return message, offset
+
+def encode(kind, message: dict, content_type=DEFAULT_FORMAT) -> bytes:
+    if content_type == BINARY:
+        return _pack(kind, message)
+    return json.dumps(message).encode('utf-8')
+
+def _is_binary(content_type):
+    if content_type == BINARY:
+        return True
+    if content_type and content_type.startswith('application/x-auction-'):
+        raise WireError(f"Unsupported binary format {content_type} (expected {BINARY})")
+    return False
+
+def decode(body: bytes, content_type=None) -> dict:
+    if _is_binary(content_type):
+        return _unpack(body)[1]
+    return json.loads(body)
+
+def new_bid(auction_id, user_id, bid_amount) -> dict:
+    return {"auction_id": auction_id, "user_id": user_id, "bid_amount": bid_amount,
+            "bid_id": uuid.uuid4().hex, "timestamp": time.time()}
+
+def encode_state(auctions: list, content_type=DEFAULT_FORMAT) -> bytes:
+    if content_type == BINARY:
+        parts = [_header.pack(VERSION, STATE), _u32.pack(len(auctions))]
+        for auction in auctions:
+            _pack_fields(AUCTION_STATE, auction, parts)
+        return b''.join(parts)
+    return json.dumps({"auctions": auctions}).encode('utf-8')
+
+def decode_state(body: bytes, content_type=None) -> list:
+    if not _is_binary(content_type):
+        return json.loads(body)["auctions"]
+    kind, _, offset = _unpack(body)
+    if kind != STATE:
+        raise WireError(f"Expected a state reply, got message type {kind}")
+    try:
+        (count,) = _u32.unpack_from(body, offset)
+        offset += _u32.size
+        auctions = []
+        for _ in range(count):
+            auction, offset = _unpack_fields(AUCTION_STATE, body, offset)
+            auctions.append(auction)
+        return auctions
+    except (struct.error, UnicodeDecodeError, TypeError, ValueError, OverflowError, OSError) as e:
+        raise WireError(f"Malformed state reply: {e}") from e
+
+def bid_payload(bid: dict, content_type=DEFAULT_FORMAT) -> bytes:
+    # the exact bytes the client signs
+    if content_type == BINARY:
+        return _pack(BID, bid)
+    return signatures.canonical_bytes(bid)
+
+def encode_signed_bid(bid: dict, payload: bytes, signature: bytes, content_type=DEFAULT_FORMAT) -> bytes:
+    if content_type == BINARY:
+        return payload + _u16.pack(len(signature)) + signature
+    signed = dict(bid)
+    signed['signature'] = base64.b64encode(signature).decode('utf-8')
+    return json.dumps(signed).encode('utf-8')
+
+def _check_bid(bid):
+    # whatever decodes is still client input: the services index and compare these fields directly
+    if not isinstance(bid, dict):
+        raise WireError(f"Expected a bid object, got {type(bid).__name__}")
+    for name, field in SCHEMAS[BID]:
+        value = bid.get(name)
+        if field == 's':
+            if not isinstance(value, str) or not value:
+                raise WireError(f"Bid field {name} must be a non-empty string")
+        elif isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise WireError(f"Bid field {name} must be a finite number")
+
+def decode_signed_bid(body: bytes, content_type=None):
+    # returns (bid, signed bytes, raw signature)
+    if _is_binary(content_type):
+        kind, bid, offset = _unpack(body)
+        if kind != BID:
+            raise WireError(f"Expected a bid, got message type {kind}")
+        try:
+            (length,) = _u16.unpack_from(body, offset)
+        except struct.error as e:
+            raise WireError(f"Missing signature: {e}") from e
+        signature = bytes(body[offset + _u16.size:offset + _u16.size + length])
+        _check_bid(bid)
+        return bid, bytes(body[:offset]), signature
+
+    bid = json.loads(body)
+    if not isinstance(bid, dict):
+        raise WireError(f"Expected a bid object, got {type(bid).__name__}")
+    sig_b64 = bid.pop('signature', None)
+    if not isinstance(sig_b64, str):
+        raise WireError("Missing signature")
+    _check_bid(bid)
+    try:
+        signature = base64.b64decode(sig_b64)
+    except (base64.binascii.Error, ValueError) as e:
+        raise WireError(f"Invalid base64 signature: {e}") from e
+    return bid, signatures.canonical_bytes(bid), signature